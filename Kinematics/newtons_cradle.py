@@ -1,11 +1,15 @@
 import sys
+import time
 import random
+import numpy as np
 import pygame
 import pymunk as pm
 from pymunk import Vec2d
 
 is_interactive = True  # Set interactive mode as default
 display_size = (600, 600)
+fps = 50
+substeps = 25  # space.step calls per frame
 
 def drawcircle(image, colour, origin, radius, width=0):
     if width == 0:
@@ -39,6 +43,108 @@ def drawcircle(image, colour, origin, radius, width=0):
         )
 
 
+def create_space(width, height, count=5):
+    """The cradle: count balls of radius 25 hanging side by side from pin joints"""
+    space = pm.Space()
+    space.gravity = (0.0, -1900.0)
+    space.damping = 0.999  # to prevent it from blowing up.
+
+    bodies = []
+    for x in range(-100, -100 + 50 * count, 50):
+        x += width / 2
+        offset_y = height / 2
+        mass = 10
+        radius = 25
+        moment = pm.moment_for_circle(mass, 0, radius, (0, 0))
+        body = pm.Body(mass, moment)
+        body.position = (x, -125 + offset_y)
+        body.start_position = Vec2d(*body.position)
+        shape = pm.Circle(body, radius)
+        shape.elasticity = 0.9999999
+        space.add(body, shape)
+        bodies.append(body)
+        pj = pm.PinJoint(space.static_body, body, (x, 125 + offset_y), (0, 0))
+        space.add(pj)
+    return space, bodies
+
+
+def create_ball_pit(width, height, count=800, radius=7):
+    """count free balls dropped into an open box"""
+    space = pm.Space()
+    space.gravity = (0.0, -1900.0)
+    space.damping = 0.999
+
+    walls = [
+        ((10, 10), (width - 10, 10)),
+        ((10, 10), (10, height)),
+        ((width - 10, 10), (width - 10, height)),
+    ]
+    for a, b in walls:
+        wall = pm.Segment(space.static_body, a, b, 5)
+        wall.elasticity = 0.5
+        wall.friction = 0.5
+        space.add(wall)
+
+    bodies = []
+    spacing = 2 * radius + 2
+    columns = int((width - 40) // spacing)
+    for i in range(count):
+        mass = 10
+        body = pm.Body(mass, pm.moment_for_circle(mass, 0, radius, (0, 0)))
+        body.position = (
+            20 + radius + (i % columns) * spacing + random.uniform(-1, 1),
+            20 + radius + (i // columns) * spacing,
+        )
+        body.start_position = Vec2d(*body.position)
+        shape = pm.Circle(body, radius)
+        shape.elasticity = 0.5
+        shape.friction = 0.5
+        space.add(body, shape)
+        bodies.append(body)
+    use_spatial_hash(space, radius)
+    return space, bodies
+
+
+def create_pendulum_grid(width, height, rows=10, radius=10, length=30):
+    """rows of touching pendulums, each row a wide Newton's cradle"""
+    space = pm.Space()
+    space.gravity = (0.0, -1900.0)
+    space.damping = 0.999
+
+    bodies = []
+    columns = int((width - 40) // (2 * radius))
+    for row in range(rows):
+        pin_y = height - 20 - row * (length + 2 * radius + 5)
+        for column in range(columns):
+            x = 20 + radius + column * 2 * radius
+            mass = 10
+            body = pm.Body(mass, pm.moment_for_circle(mass, 0, radius, (0, 0)))
+            body.position = (x, pin_y - length)
+            body.start_position = Vec2d(*body.position)
+            shape = pm.Circle(body, radius)
+            shape.elasticity = 0.9999999
+            space.add(body, shape)
+            bodies.append(body)
+            space.add(pm.PinJoint(space.static_body, body, (x, pin_y), (0, 0)))
+    use_spatial_hash(space, radius)
+    return space, bodies
+
+
+def use_spatial_hash(space, radius):
+    """Swap the default bounding box tree for a spatial hash, which suits many balls of one size.
+    Cells two balls across measured fastest on a 2000 ball pit (about 20% faster than the tree,
+    one-ball cells were slower than the tree); about 10x as many cells as shapes keeps hash
+    collisions rare, as pymunk suggests."""
+    space.use_spatial_hash(4 * radius, 10 * len(space.shapes))
+
+
+scenes = {
+    "cradle": create_space,
+    "ball pit": create_ball_pit,
+    "pendulum grid": create_pendulum_grid,
+}
+
+
 def reset_bodies(space):
     for body in space.bodies:
         body.position = Vec2d(*body.start_position)
@@ -53,6 +159,83 @@ def reset_bodies(space):
         shape.color = color
 
 
+def score_cradle(count, steps, iterations, seconds=4.0, speed=600.0):
+    """Swing count balls into the rest of the cradle and follow it for seconds.
+
+    Every impact should hand the incoming momentum of count balls at one end to the count balls
+    at the other end. An impact is a frame in which the incoming group has lost more than half
+    its momentum of the last 0.1 s; it is scored by the most momentum the far group carries away
+    in the next 0.1 s over the momentum that came in, so balls that merely rebound or a cradle
+    swinging as one block score low. A ratio r above 1 (momentum made up by the solver) scores
+    1 / r, so gains count as much as losses. fidelity is the mean score over all impacts of the
+    run, kept is the share of the initial energy left at the end. Returns fidelity, kept and the
+    number of space.step calls.
+    """
+    space, bodies = create_space(*display_size)
+    space.iterations = iterations
+    for body in bodies[:count]:
+        body.velocity = (speed, 0)
+    rest_y = bodies[0].position.y
+    mass = bodies[0].mass
+
+    def energy():
+        return sum(
+            0.5 * body.mass * body.velocity.length ** 2
+            - body.mass * space.gravity.y * (body.position.y - rest_y)
+            for body in bodies
+        )
+
+    start = energy()
+    dt = 1.0 / float(fps) / float(steps)
+    frames = int(round(seconds * fps))
+    velocities = []
+    for frame in range(frames):
+        for x in range(steps):
+            space.step(dt)
+        velocities.append([body.velocity.x for body in bodies])
+
+    # momentum of the first and last count balls, towards the far end of the cradle
+    momentum = mass * np.array(velocities)
+    rightwards = momentum[:, :count].sum(1), momentum[:, -count:].sum(1)
+    leftwards = -momentum[:, -count:].sum(1), -momentum[:, :count].sum(1)
+    incoming_0 = mass * speed * count
+    window = max(1, fps // 10)  # impacts spread over a few frames with coarse substeps
+    scores = []
+    for incoming, outgoing in (rightwards, leftwards):
+        k = window
+        while k < frames - window:
+            peak = incoming[k - window:k].max()
+            if peak > 0.25 * incoming_0 and incoming[k] < 0.5 * peak:
+                ratio = max(outgoing[k:k + window].max(), 0) / peak
+                scores.append(min(ratio, 1 / ratio) if ratio > 0 else 0.0)
+                k += 2 * window
+            else:
+                k += 1
+    fidelity = np.mean(scores) if scores else 0.0
+    return fidelity, energy() / start, frames * steps
+
+
+def benchmark(substep_counts=(1, 2, 5, 10, 25, 50), iteration_counts=(1, 5, 10, 20, 40)):
+    """Table of speed and 1/2/3-ball fidelity for every substeps x iterations pair, without a display"""
+    print(
+        "substeps  iterations  steps/s  frames/s  fidelity 1/2/3 ball    energy kept"
+    )
+    for steps in substep_counts:
+        for iterations in iteration_counts:
+            fidelity, kept, calls = [], [], 0
+            start = time.perf_counter()
+            for count in (1, 2, 3):
+                f, k, c = score_cradle(count, steps, iterations)
+                fidelity.append(f)
+                kept.append(k)
+                calls += c
+            rate = calls / (time.perf_counter() - start)
+            print(
+                "%8d  %10d  %7.0f  %8.0f  %6.3f %6.3f %6.3f  %11.3f"
+                % (steps, iterations, rate, rate / steps, *fidelity, min(kept))
+            )
+
+
 def main():
     pygame.init()
     screen = pygame.display.set_mode(display_size)
@@ -70,31 +253,24 @@ def main():
     font = pygame.font.Font(None, 16)
 
     ### Physics stuff
-    space = pm.Space()
-    space.gravity = (0.0, -1900.0)
-    space.damping = 0.999  # to prevent it from blowing up.
+    scene = "cradle"
+    space, bodies = create_space(width, height)
     mouse_body = pm.Body(body_type=pm.Body.KINEMATIC)
 
-    bodies = []
-    for x in range(-100, 150, 50):
-        x += width / 2
-        offset_y = height / 2
-        mass = 10
-        radius = 25
-        moment = pm.moment_for_circle(mass, 0, radius, (0, 0))
-        body = pm.Body(mass, moment)
-        body.position = (x, -125 + offset_y)
-        body.start_position = Vec2d(*body.position)
-        shape = pm.Circle(body, radius)
-        shape.elasticity = 0.9999999
-        space.add(body, shape)
-        bodies.append(body)
-        pj = pm.PinJoint(space.static_body, body, (x, 125 + offset_y), (0, 0))
-        space.add(pj)
-
     reset_bodies(space)
     selected = None
 
+    sprites = {}  # one pre-drawn ball per colour and radius, blitted for every ball
+
+    def ball_sprite(colour, radius):
+        key = (tuple(colour), radius)
+        if key not in sprites:
+            sprite = pygame.Surface((2 * radius, 2 * radius))
+            drawcircle(sprite, colour, (radius, radius), radius, 0)
+            sprite.set_colorkey((0, 0, 0))  # colour keys blit about twice as fast as per-pixel alpha
+            sprites[key] = sprite.convert()
+        return sprites[key]
+
     pygame.mouse.set_visible(True)
 
     while running:
@@ -107,6 +283,12 @@ def main():
 
             if event.type == pygame.KEYDOWN and event.key == pygame.K_r:
                 reset_bodies(space)
+            elif event.type == pygame.KEYDOWN and event.key == pygame.K_p:
+                names = list(scenes)
+                scene = names[(names.index(scene) + 1) % len(names)]
+                space, bodies = scenes[scene](width, height)
+                reset_bodies(space)
+                selected = None
             elif event.type == pygame.KEYDOWN and event.key == pygame.K_a:
                 r = random.randint(1, 4)
                 for body in bodies[0:r]:
@@ -117,7 +299,7 @@ def main():
                     space.remove(selected)
                 p = from_pygame(Vec2d(*event.pos))
                 hit = space.point_query_nearest(p, 0, pm.ShapeFilter())
-                if hit != None:
+                if hit != None and hit.shape.body.body_type == pm.Body.DYNAMIC:
                     shape = hit.shape
                     rest_length = mouse_body.position.get_distance(shape.body.position)
                     ds = pm.DampedSpring(
@@ -149,15 +331,25 @@ def main():
             p2 = to_pygame(pv2)
             pygame.draw.aalines(screen, pygame.Color("lightgray"), False, [p1, p2])
 
-        for ball in space.shapes:
-            p = to_pygame(ball.body.position)
-            drawcircle(screen, ball.color, p, int(ball.radius), 0)
+        balls = []
+        for shape in space.shapes:
+            if isinstance(shape, pm.Circle):
+                x, y = to_pygame(shape.body.position)
+                radius = int(shape.radius)
+                balls.append((ball_sprite(shape.color, radius), (x - radius, y - radius)))
+            else:
+                pygame.draw.line(
+                    screen,
+                    pygame.Color("darkgrey"),
+                    to_pygame(shape.a),
+                    to_pygame(shape.b),
+                    2 * int(shape.radius),
+                )
+        screen.blits(balls, False)
 
         ### Update physics
-        fps = 50
-        iterations = 25
-        dt = 1.0 / float(fps) / float(iterations)
-        for x in range(iterations):  # 10 iterations to get a more stable simulation
+        dt = 1.0 / float(fps) / float(substeps)
+        for x in range(substeps):  # several substeps to get a more stable simulation
             space.step(dt)
 
         ### Flip screen
@@ -165,6 +357,20 @@ def main():
             font.render("fps: " + str(clock.get_fps()), True, pygame.Color("white")),
             (0, 0),
         )
+        screen.blit(
+            font.render(
+                "Scene: %s, %d balls" % (scene, len(bodies)), True, pygame.Color("white")
+            ),
+            (0, 15),
+        )
+        screen.blit(
+            font.render(
+                "Press P to switch between cradle, ball pit and pendulum grid",
+                True,
+                pygame.Color("darkgrey"),
+            ),
+            (5, height - 95),
+        )
         screen.blit(
             font.render(
                 "Press left mouse button and drag to interact",
@@ -214,4 +420,6 @@ def main():
 
 
 if __name__ == "__main__":
+    if "--benchmark" in sys.argv:
+        sys.exit(benchmark())
     sys.exit(main())
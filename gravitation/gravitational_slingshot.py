@@ -1,5 +1,15 @@
-import pygame
+import os
+import sys
 import math
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+if '--survey' in sys.argv:
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy') # the survey needs no window, and neither do its worker processes
+
+import pygame
 
 pygame.init()
 
@@ -15,6 +25,16 @@ FPS = 60
 PLANET_SIZE = 50 # radius of planet
 OBJ_SIZE = 5
 VEL_SCALE = 100
+FAN_PROBES = 2000 # probes spawned by one launch of the fan tool
+FAN_SPREAD = math.radians(30) # full opening angle of the fan
+FIELD_CELL = 4 # grid spacing of the tabulated planet field, in pixels
+NEAR_FIELD = 2 * PLANET_SIZE # inside this distance of a planet its pull is computed exactly
+PREVIEW_STEPS = 3000 # how far ahead the aiming preview predicts, in frames
+PREVIEW_BUDGET = 0.004 # seconds per frame the preview may spend integrating
+PREVIEW_QUANTUM = 4 # mouse positions are snapped to this many pixels to share cached predictions
+SURVEY_STEPS = 3000 # frames a surveyed launch is followed before it counts as captured
+SURVEY_BLOCK = 20000 # launches advanced together by one survey worker
+ESCAPED, COLLIDED, CAPTURED = 0, 1, 2 # survey outcomes
 
 BG = pygame.transform.scale(pygame.image.load("gravitation/assets/background.jpg"), (WIDTH, HEIGHT))
 PLANET = pygame.transform.scale(pygame.image.load("gravitation/assets/planet.png"), (PLANET_SIZE*2, PLANET_SIZE*2))
@@ -22,6 +42,10 @@ PLANET = pygame.transform.scale(pygame.image.load("gravitation/assets/planet.png
 WHITE = (255, 255, 255) # rgb colour code
 RED = (255, 0, 0)
 BLUE = (0, 0, 255)
+GREY = (150, 150, 150)
+FONT = pygame.font.SysFont("Trebuchet MS", 16)
+PROBE = pygame.Surface((OBJ_SIZE*2, OBJ_SIZE*2), pygame.SRCALPHA) # one pre-drawn probe, blitted for every spacecraft
+pygame.draw.circle(PROBE, RED, (OBJ_SIZE, OBJ_SIZE), OBJ_SIZE)
 
 class Planet:
     def __init__(self, x, y, mass):
@@ -60,6 +84,226 @@ class Spacecraft:
         pygame.draw.circle(window, RED, (int(self.x), int(self.y)), OBJ_SIZE)
 
 
+def planet_field(pos, centre, mass, near=0):
+    # pull and potential of one planet at pos (n, 2); with near > 0 the pull inside near is replaced by
+    # G * mass * r * (5 - 3 * (r / near)**2) / (2 * near**3), which meets 1/r^2 at near with a matching slope
+    d = centre - pos
+    r = np.sqrt(np.sum(d**2, -1))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pull = G * mass / r**3
+        potential = -G * mass / r
+        if near:
+            x2 = (r / near)**2
+            pull = np.where(x2 < 1, G * mass * (5 - 3 * x2) / (2 * near**3), pull)
+            potential = np.where(x2 < 1, -G * mass / near * (1 + 5 / 4 * (1 - x2) - 3 / 8 * (1 - x2**2)), potential)
+        acceleration = np.nan_to_num(pull[..., None] * d) # no pull at the very centre
+    return acceleration, potential
+
+
+class FieldGrid:
+    # acceleration and potential of static planets, tabulated once every FIELD_CELL pixels and sampled bilinearly
+    # the table holds the planets smoothed by planet_field, so it never has to resolve the 1/r^2 spike;
+    # probes within NEAR_FIELD of a planet get the difference between its exact and smoothed pull added back
+    # every cell also lists the planets whose near field reaches it, so a probe costs the same in any scene
+    def __init__(self, planets, cell=FIELD_CELL, near=NEAR_FIELD):
+        self.cell = cell
+        self.near = near
+        self.centres = np.array([[planet.x, planet.y] for planet in planets], dtype=float)
+        self.masses = np.array([planet.mass for planet in planets], dtype=float)
+
+        x = np.arange(0, WIDTH + cell, cell)
+        y = np.arange(0, HEIGHT + cell, cell)
+        nodes = np.stack(np.meshgrid(x, y, indexing='ij'), -1).astype(float)
+        self.acceleration = np.zeros(nodes.shape)
+        self.potential = np.zeros(nodes.shape[:2])
+        for centre, mass in zip(self.centres, self.masses):
+            acceleration, potential = planet_field(nodes, centre, mass, near)
+            self.acceleration += acceleration
+            self.potential += potential
+
+        # planets whose near field touches each cell, padded with -1
+        corner = nodes[:-1, :-1]
+        touches = []
+        for centre in self.centres:
+            closest = np.clip(centre, corner, corner + cell)
+            touches.append(np.sum((closest - centre)**2, -1) < near**2)
+        touches = np.array(touches).reshape(len(self.centres), -1)
+        depth = max(1, touches.sum(0).max(initial=0))
+        order = np.argsort(~touches, 0, kind='stable')[:depth]
+        self.near_planets = np.where(np.take_along_axis(touches, order, 0), order, -1).T.reshape(corner.shape[:2] + (depth,))
+
+        # cells wholly inside a planet (1), crossed by a planet's surface (2) or clear of every planet (0)
+        self.contact = np.zeros(corner.shape[:2], dtype=np.int8)
+        for centre in self.centres:
+            closest = np.clip(centre, corner, corner + cell)
+            farthest = np.where(np.abs(corner - centre) > np.abs(corner + cell - centre), corner, corner + cell)
+            inside = np.sum((farthest - centre)**2, -1) <= PLANET_SIZE**2
+            crossed = (np.sum((closest - centre)**2, -1) <= PLANET_SIZE**2) & ~inside
+            self.contact[crossed & (self.contact == 0)] = 2
+            self.contact[inside] = 1
+
+    def sample(self, pos):
+        # returns the acceleration (n, 2) and potential (n,) at pos (n, 2)
+        u = pos / self.cell
+        size = np.array(self.potential.shape) - 2
+        index = np.clip(np.floor(u).astype(int), 0, size)
+        f = np.clip(u - index, 0, 1)
+        i, j = index.T
+        fx, fy = f[:, :1], f[:, 1:]
+        weights = ((1 - fx) * (1 - fy), fx * (1 - fy), (1 - fx) * fy, fx * fy)
+        corners = ((i, j), (i + 1, j), (i, j + 1), (i + 1, j + 1))
+        acceleration = sum(w * self.acceleration[c] for w, c in zip(weights, corners))
+        potential = sum(w[:, 0] * self.potential[c] for w, c in zip(weights, corners))
+
+        for planet in self.near_planets[i, j].T:
+            close = planet >= 0
+            centre, mass = self.centres[planet[close]], self.masses[planet[close]]
+            exact = planet_field(pos[close], centre, mass)
+            smooth = planet_field(pos[close], centre, mass, self.near)
+            acceleration[close] += exact[0] - smooth[0]
+            potential[close] += exact[1] - smooth[1]
+        return acceleration, potential
+
+    def collided(self, pos):
+        # probes inside a planet: the cell says so outright unless a planet's surface crosses it,
+        # and only those few probes are tested against the planets listed for their cell
+        # (every planet a probe can touch is listed, since PLANET_SIZE < near)
+        # probes off the grid take the nearest edge cell; they are off screen and dropped anyway
+        nx, ny = self.contact.shape
+        i = (pos[:, 0] / self.cell).astype(np.intp).clip(0, nx - 1) # truncation is floor once clipped at 0
+        j = (pos[:, 1] / self.cell).astype(np.intp).clip(0, ny - 1)
+        cell = i * ny + j
+        contact = self.contact.ravel()[cell]
+        hit = contact == 1
+        edge = np.flatnonzero(contact == 2)
+        near = self.near_planets.reshape(nx * ny, -1)[cell[edge]]
+        probe, slot = np.nonzero(near >= 0)
+        planet = near[probe, slot]
+        inside = np.sum((pos[edge[probe]] - self.centres[planet])**2, 1) <= PLANET_SIZE**2
+        hit[edge[probe[inside]]] = True
+        return hit
+
+
+class Swarm:
+    # every spacecraft in flat arrays, so the whole swarm moves in one vectorised step
+    # the physics is the same as Spacecraft.move: the velocity is kicked by the pull of each planet, then the position drifts
+    def __init__(self):
+        self.pos = np.zeros((0, 2))
+        self.vel = np.zeros((0, 2))
+
+    def __len__(self):
+        return len(self.pos)
+
+    def add(self, pos, vel):
+        self.pos = np.vstack((self.pos, np.reshape(pos, (-1, 2))))
+        self.vel = np.vstack((self.vel, np.reshape(vel, (-1, 2))))
+
+    def move(self, planets, field=None):
+        # with a FieldGrid of the planets the pull is looked up instead of summed over every planet
+        if field is not None:
+            acceleration = field.sample(self.pos)[0]
+        else:
+            acceleration = np.zeros_like(self.pos)
+            for planet in planets:
+                d = np.array([planet.x, planet.y]) - self.pos
+                r2 = np.sum(d**2, 1)
+                r2[r2 == 0] = np.inf # a probe sitting on the planet centre feels no pull and is removed as collided
+                acceleration += (G * planet.mass / r2 / np.sqrt(r2))[:, None] * d
+        self.vel += acceleration
+        self.pos += self.vel
+
+    def lost(self, planets, field=None):
+        # masks of the probes that left the screen and of those that hit a planet
+        # with a FieldGrid only the planets near each probe's cell are tested
+        x, y = self.pos.T
+        off_screen = (x < 0) | (x > WIDTH) | (y < 0) | (y > HEIGHT)
+        if field is not None:
+            return off_screen, field.collided(self.pos)
+        collided = np.zeros(len(self), dtype=bool)
+        for planet in planets:
+            collided |= (x - planet.x)**2 + (y - planet.y)**2 <= PLANET_SIZE**2
+        return off_screen, collided
+
+    def keep(self, mask):
+        self.pos = self.pos[mask]
+        self.vel = self.vel[mask]
+
+    def remove_lost(self, planets, field=None):
+        # drops every lost probe with one mask instead of a list.remove per probe
+        off_screen, collided = self.lost(planets, field)
+        self.keep(~(off_screen | collided))
+
+    def draw(self):
+        corners = (self.pos - OBJ_SIZE).astype(int).tolist()
+        window.blits([(PROBE, corner) for corner in corners], False)
+
+
+def create_fan(Location, mouse, n=FAN_PROBES, spread=FAN_SPREAD):
+    # n probes from one point, with the launch speed of create_ship and directions fanned out around the aim
+    t_x, t_y = Location
+    m_x, m_y = mouse
+    speed = math.hypot(m_x - t_x, m_y - t_y) / VEL_SCALE
+    angle = math.atan2(m_y - t_y, m_x - t_x) + np.linspace(-spread / 2, spread / 2, n)
+    pos = np.tile([t_x, t_y], (n, 1)).astype(float)
+    vel = speed * np.column_stack((np.cos(angle), np.sin(angle)))
+    return pos, vel
+
+
+class TrajectoryPreview:
+    # predicted path of the launch being aimed, with the physics of Spacecraft.move summed over all planets
+    # every frame only PREVIEW_BUDGET seconds of integration are done, continuing where the last frame stopped,
+    # and paths are cached per launch point and quantised mouse position so moving back over them is free
+    def __init__(self, steps=PREVIEW_STEPS, budget=PREVIEW_BUDGET, quantum=PREVIEW_QUANTUM, cache_size=256):
+        self.steps = steps
+        self.budget = budget
+        self.quantum = quantum
+        self.cache_size = cache_size
+        self.cache = OrderedDict() # (start, mouse) -> [points, state, done]
+
+    def snap(self, mouse):
+        # the aim the preview is computed for; launches use it too, so the drawn path is the real one
+        return tuple(round(m / self.quantum) * self.quantum for m in mouse)
+
+    def update(self, start, mouse, planets):
+        # returns the points predicted so far for a launch from start towards mouse
+        mouse = self.snap(mouse)
+        key = (tuple(start), mouse)
+        if key not in self.cache:
+            obj = create_ship(start, mouse)
+            self.cache[key] = [[(obj.x, obj.y)], (obj.x, obj.y, obj.x_vel, obj.y_vel), False]
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        self.cache.move_to_end(key)
+        entry = self.cache[key]
+        if not entry[2]:
+            self.integrate(entry, [(planet.x, planet.y, planet.mass) for planet in planets])
+        return entry[0]
+
+    def integrate(self, entry, bodies):
+        points, (x, y, x_vel, y_vel), done = entry
+        start = time.perf_counter()
+        while not done and len(points) <= self.steps and time.perf_counter() - start < self.budget:
+            for _ in range(100):
+                for p_x, p_y, mass in bodies:
+                    d_x, d_y = p_x - x, p_y - y
+                    distance = math.sqrt(d_x**2 + d_y**2)
+                    if distance == 0:
+                        continue # no pull on the planet centre, as in Swarm.move; the probe ends as collided
+                    acceleration = G * mass / distance**3
+                    x_vel += acceleration * d_x
+                    y_vel += acceleration * d_y
+                x += x_vel
+                y += y_vel
+                points.append((x, y))
+                off_screen = x < 0 or x > WIDTH or y < 0 or y > HEIGHT
+                collided = any((x - p_x)**2 + (y - p_y)**2 <= PLANET_SIZE**2 for p_x, p_y, _ in bodies)
+                if off_screen or collided or len(points) > self.steps:
+                    done = True
+                    break
+        entry[1] = (x, y, x_vel, y_vel)
+        entry[2] = done
+
+
 def create_ship(Location, mouse):
     t_x, t_y = Location
     m_x, m_y = mouse
@@ -69,12 +313,68 @@ def create_ship(Location, mouse):
     return obj
 
 
+def survey_block(args):
+    # outcome and change of speed of a block of launches, all flown together as one Swarm
+    pos, vel, steps = args
+    planets = [Planet(WIDTH // 2, HEIGHT // 2, PLANET_MASS)]
+    swarm = Swarm()
+    swarm.add(pos, vel)
+    index = np.arange(len(vel)) # which launch each remaining probe is
+    outcome = np.full(len(vel), CAPTURED, dtype=np.uint8)
+    delta_v = np.full(len(vel), np.nan, dtype=np.float32)
+    for _ in range(steps):
+        if not len(swarm):
+            break
+        swarm.move(planets)
+        off_screen, collided = swarm.lost(planets)
+        escaped = off_screen & ~collided
+        outcome[index[escaped]] = ESCAPED
+        delta_v[index[escaped]] = np.hypot(*swarm.vel[escaped].T) - np.hypot(*vel[index[escaped]].T)
+        outcome[index[collided]] = COLLIDED
+        left = ~(off_screen | collided)
+        swarm.keep(left)
+        index = index[left]
+    return outcome, delta_v
+
+
+def survey(sweep="velocity", start=(100, 100), velocity=(2, 0), max_speed=4, n=1000, steps=SURVEY_STEPS,
+           path="slingshot_survey.npz", workers=None):
+    # sweeps an n x n grid of launches across a process pool, in pixels and pixels per frame like create_ship
+    # sweep "velocity": launch velocities in [-max_speed, max_speed]^2, all from start
+    # sweep "position": launch points covering the screen, all with velocity
+    # outcome[i, j] and delta_v[i, j] belong to the launch at axis_x[j], axis_y[i]; delta_v is the speed gained
+    # by the launches that escape the screen and NaN for the others
+    if sweep == "velocity":
+        axis_x = axis_y = np.linspace(-max_speed, max_speed, n)
+    elif sweep == "position":
+        axis_x = np.linspace(0, WIDTH, n)
+        axis_y = np.linspace(0, HEIGHT, n)
+    else:
+        raise ValueError(f"unknown sweep '{sweep}'")
+    grid = np.stack(np.meshgrid(axis_x, axis_y), -1).reshape(-1, 2)
+    pos = grid if sweep == "position" else np.tile(np.array(start, dtype=float), (len(grid), 1))
+    vel = grid if sweep == "velocity" else np.tile(np.array(velocity, dtype=float), (len(grid), 1))
+    blocks = np.array_split(np.arange(len(grid)), max(1, len(grid) // SURVEY_BLOCK))
+    with ProcessPoolExecutor(workers) as pool:
+        results = list(pool.map(survey_block, [(pos[block], vel[block], steps) for block in blocks]))
+    outcome = np.concatenate([result[0] for result in results]).reshape(n, n)
+    delta_v = np.concatenate([result[1] for result in results]).reshape(n, n)
+    np.savez(path, outcome=outcome, delta_v=delta_v, sweep=sweep, axis_x=axis_x, axis_y=axis_y,
+             start=np.array(start), velocity=np.array(velocity), max_speed=max_speed, steps=steps)
+    return outcome, delta_v
+
+
 def main():
     running = True
     clock = pygame.time.Clock()
 
     planet = Planet(WIDTH // 2, HEIGHT // 2, PLANET_MASS)
-    objects = []
+    planets = [planet]
+    swarm = Swarm()
+    fan = False # launch a whole fan of probes instead of a single spacecraft
+    field = FieldGrid(planets) # the planets never move, so their field is tabulated once
+    use_field = False
+    preview = TrajectoryPreview()
     temp_obj_pos = None # stores any object that we've placed onto the screen that we've not yet launched
 
     while running:
@@ -86,11 +386,20 @@ def main():
             if event.type == pygame.QUIT:
                 running = False
 
+            if event.type == pygame.KEYDOWN and event.key == pygame.K_f:
+                fan = not fan
+
+            if event.type == pygame.KEYDOWN and event.key == pygame.K_g:
+                use_field = not use_field
+
             if event.type == pygame.MOUSEBUTTONDOWN:
                 if temp_obj_pos:
-                    t_x, t_y = temp_obj_pos
-                    obj = create_ship(temp_obj_pos, mouse_pos)
-                    objects.append(obj)
+                    aim = preview.snap(mouse_pos)
+                    if fan:
+                        swarm.add(*create_fan(temp_obj_pos, aim))
+                    else:
+                        obj = create_ship(temp_obj_pos, aim)
+                        swarm.add((obj.x, obj.y), (obj.x_vel, obj.y_vel))
                     temp_obj_pos = None
                 else:
                     temp_obj_pos = mouse_pos
@@ -98,22 +407,52 @@ def main():
         window.blit(BG, (0, 0))
 
         if temp_obj_pos:
-            pygame.draw.line(window, WHITE, temp_obj_pos, mouse_pos, 2)
+            path = preview.update(temp_obj_pos, mouse_pos, planets)
+            if len(path) > 1:
+                pygame.draw.lines(window, GREY, False, path, 1)
+            pygame.draw.line(window, WHITE, temp_obj_pos, preview.snap(mouse_pos), 2)
             pygame.draw.circle(window, RED, temp_obj_pos, OBJ_SIZE)
 
-        for obj in objects[:]:
-            obj.draw()
-            obj.move(planet)
-            off_screen = obj.x < 0 or obj.x > WIDTH or obj.y < 0 or obj.y > HEIGHT
-            collided = math.sqrt((obj.x - planet.x)**2 + (obj.y - planet.y)**2) <= PLANET_SIZE
-            if off_screen or collided:
-                objects.remove(obj)
+        swarm.draw()
+        swarm.move(planets, field if use_field else None)
+        swarm.remove_lost(planets, field if use_field else None)
 
         planet.draw()
 
+        text = FONT.render(f"Probes: {len(swarm)}    Press F for launch fan: {'on' if fan else 'off'}", True, WHITE)
+        window.blit(text, (10, 10))
+        text = FONT.render(f"Press G for field grid: {'on' if use_field else 'off'}", True, WHITE)
+        window.blit(text, (10, 30))
+
         pygame.display.update()
 
     pygame.quit()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    if '--survey' in sys.argv:
+        # python gravitational_slingshot.py --survey [n] [path] [--position] [--start X,Y] [--velocity VX,VY]
+        #                                   [--max-speed V]
+        args = sys.argv[sys.argv.index('--survey') + 1:]
+        options = {}
+        for flag, key in (('--start', 'start'), ('--velocity', 'velocity')):
+            if flag in args:
+                value = args.pop(args.index(flag) + 1)
+                args.remove(flag)
+                options[key] = tuple(float(v) for v in value.split(','))
+        if '--max-speed' in args:
+            options['max_speed'] = float(args.pop(args.index('--max-speed') + 1))
+            args.remove('--max-speed')
+        if '--position' in args:
+            options['sweep'] = "position"
+            args.remove('--position')
+        if args:
+            options['n'] = int(args[0])
+        if len(args) > 1:
+            options['path'] = args[1]
+        t = time.time()
+        outcome, delta_v = survey(**options)
+        print(f"{outcome.size} launches in {time.time() - t:.1f} s: "
+              f"{np.mean(outcome == ESCAPED):.1%} escaped, {np.mean(outcome == COLLIDED):.1%} collided, "
+              f"{np.mean(outcome == CAPTURED):.1%} captured, {np.mean(delta_v > 0):.1%} gained speed")
+    else:
+        main()
@@ -1,5 +1,10 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import matplotlib.pyplot as plt
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
 
 def getAcc( pos, mass, G, softening ):
 	"""
@@ -33,6 +38,529 @@ def getAcc( pos, mass, G, softening ):
 
 	return a
 	
+def getAccTile( pos_i, pos_j, mass_j, softening, dtype, potential=False, acceleration=True ):
+	"""
+	Acceleration (without G) on one block of particles from another block
+	pos_i  is an M x 3 matrix of target positions
+	pos_j  is an K x 3 matrix of source positions
+	mass_j is a K x 1 vector of source masses
+	softening is the softening length
+	dtype  is the floating point type of the pairwise arithmetic
+	potential also returns sum_j m_j / r_ij (unsoftened, as in getEnergy)
+	acceleration can be switched off for a potential-only sweep
+	a      is M x 3 matrix of accelerations (None unless acceleration is set)
+	phi    is an M vector of potentials (None unless potential is set)
+	"""
+	pi = pos_i.astype(dtype, copy=False)
+	pj = pos_j.astype(dtype, copy=False)
+	mj = mass_j.astype(dtype, copy=False).T
+
+	# M x K pairwise separations r_j - r_i
+	dx = pj[:,0] - pi[:,0:1]
+	dy = pj[:,1] - pi[:,1:2]
+	dz = pj[:,2] - pi[:,2:3]
+
+	# squared distances, built in place to keep the number of M x K temporaries low
+	r2 = dx**2
+	r2 += dy**2
+	r2 += dz**2
+
+	# m_j / r, from the same separations
+	phi = None
+	if potential:
+		inv_r = np.sqrt(r2)   # sqrt and divide are cheaper than power(-0.5)
+		np.divide(1, inv_r, out=inv_r, where=inv_r>0)
+		phi = inv_r @ mj.T[:,0]
+		del inv_r
+
+	if not acceleration:
+		return None, phi
+
+	# m_j / r^3
+	inv_r3 = r2
+	inv_r3 += dtype(softening**2)
+	np.power(inv_r3, -1.5, out=inv_r3, where=inv_r3>0)
+	inv_r3 *= mj
+
+	a = np.empty((pi.shape[0],3), dtype=dtype)
+	a[:,0] = np.einsum('ij,ij->i', dx, inv_r3)
+	a[:,1] = np.einsum('ij,ij->i', dy, inv_r3)
+	a[:,2] = np.einsum('ij,ij->i', dz, inv_r3)
+
+	return a, phi
+
+
+def sumTiles( pos, mass, softening, tile, dtype, workers, potential, targets=None, acceleration=True ):
+	"""
+	Sum getAccTile over all i/j blocks, one thread pool task per row of tiles
+	targets is an M x 3 matrix of positions to evaluate at (default: pos)
+	acceleration can be switched off for a potential-only sweep
+	a     is M x 3 matrix of accelerations (without G; None unless acceleration is set)
+	phi   is an M vector of potentials (None unless potential is set)
+	"""
+	if targets is None:
+		targets = pos
+	N = pos.shape[0]
+	M = targets.shape[0]
+	a = np.zeros((M,3)) if acceleration else None
+	phi = np.zeros(M) if potential else None
+
+	def row( i0 ):
+		# all source tiles acting on the target tile i0:i0+tile
+		i1 = min(i0+tile, M)
+		for j0 in range(0, N, tile):
+			j1 = min(j0+tile, N)
+			da, dphi = getAccTile( targets[i0:i1], pos[j0:j1], mass[j0:j1], softening, dtype, potential, acceleration )
+			if acceleration:
+				a[i0:i1] += da
+			if potential:
+				phi[i0:i1] += dphi
+
+	# NumPy releases the GIL inside the tile arithmetic, so threads run in parallel
+	with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+		list(pool.map(row, range(0, M, tile)))
+
+	return a, phi
+
+
+def getAccTiled( pos, mass, G, softening, tile=1024, dtype=np.float64, workers=None ):
+	"""
+	Calculate the acceleration on each particle by a tiled direct sum
+	pos     is an N x 3 matrix of positions
+	mass    is an N x 1 vector of masses
+	G       is Newton's Gravitational constant
+	softening is the softening length
+	tile    is the block size; each worker holds a few tile x tile temporaries
+	dtype   is np.float64, or np.float32 for faster single precision tiles
+	        (partial sums are still accumulated in float64)
+	workers is the number of threads (default: all cores)
+	a       is N x 3 matrix of accelerations, the same as getAcc
+	"""
+	a, _ = sumTiles( pos, mass, softening, tile, dtype, workers, False )
+
+	return G * a
+
+
+def getAccPot( pos, mass, G, softening, tile=1024, dtype=np.float64, workers=None ):
+	"""
+	Calculate the accelerations and the potential energy in one pairwise sweep
+	pos     is an N x 3 matrix of positions
+	mass    is an N x 1 vector of masses
+	G       is Newton's Gravitational constant
+	softening is the softening length
+	tile, dtype, workers are as in getAccTiled
+	a       is N x 3 matrix of accelerations, the same as getAcc
+	PE      is the potential energy of the system, the same as getEnergy
+	"""
+	a, phi = sumTiles( pos, mass, softening, tile, dtype, workers, True )
+
+	# every pair appears twice in sum_i m_i phi_i
+	PE = -0.5 * G * np.sum( mass[:,0] * phi )
+
+	return G * a, PE
+
+
+def getPotentialEnergy( pos, mass, G, tile=1024, dtype=np.float64, workers=None ):
+	"""
+	Calculate only the potential energy, in a tiled sweep without the force arithmetic
+	pos     is an N x 3 matrix of positions
+	mass    is an N x 1 vector of masses
+	G       is Newton's Gravitational constant
+	tile, dtype, workers are as in getAccTiled
+	PE      is the potential energy of the system, the same as getEnergy
+	"""
+	_, phi = sumTiles( pos, mass, 0.0, tile, dtype, workers, True, acceleration=False )
+
+	return -0.5 * G * np.sum( mass[:,0] * phi )
+
+
+def getTimestepLevels( acc, dt, maxLevel, eta, softening ):
+	"""
+	Assign each particle to a level of the power-of-two timestep hierarchy
+	acc      is an N x 3 matrix of accelerations
+	dt       is the level 0 (largest) timestep
+	maxLevel is the finest level, with timestep dt / 2**maxLevel
+	eta      is the accuracy parameter of dt_i = eta * sqrt(softening / |a_i|)
+	softening is the softening length
+	level    is an N vector of levels; particle i steps with dt / 2**level[i]
+	"""
+	a = np.sqrt(np.sum(acc**2, 1))
+	dt_i = eta * np.sqrt(softening / np.maximum(a, 1e-300))
+	level = np.ceil(np.log2(dt / dt_i))
+
+	return np.clip(level, 0, maxLevel).astype(int)
+
+
+def blockStep( pos, vel, acc, mass, G, softening, dt, level, maxLevel, eta ):
+	"""
+	Advance the system by dt with hierarchical block timesteps (KDK leapfrog).
+	Only the particles that finish their step on a sub-step get new forces,
+	from the tiled direct sum (sumTiles)
+	pos, vel, acc are N x 3 matrices, updated in place
+	mass     is an N x 1 vector of masses
+	G        is Newton's Gravitational constant
+	softening is the softening length
+	dt       is the level 0 timestep; all particles are synchronised after it
+	level    is an N vector of timestep levels, updated in place
+	maxLevel is the finest level, with timestep dt / 2**maxLevel
+	eta      is the accuracy parameter of getTimestepLevels
+	nForce   is the number of particle force evaluations that were needed
+	"""
+	nSub = 2**maxLevel
+	dtMin = dt / nSub
+	nForce = 0
+
+	for s in range(nSub):
+		# particles that begin a step now get their opening (1/2) kick
+		period = 2**(maxLevel - level)
+		start = s % period == 0
+		vel[start] += acc[start] * (dt / 2.0**level[start])[:,None] / 2.0
+
+		# drift everyone to the end of the sub-step
+		pos += vel * dtMin
+
+		# particles that finish their step now get new forces and the closing (1/2) kick
+		active = np.flatnonzero((s+1) % period == 0)
+		acc[active] = G * sumTiles( pos, mass, softening, 1024, np.float64, None, False, pos[active] )[0]
+		vel[active] += acc[active] * (dt / 2.0**level[active])[:,None] / 2.0
+		nForce += active.size
+
+		# new levels, no coarser than the coarsest level that is synchronised now
+		sync = (s+1) & -(s+1)
+		lMin = maxLevel - int(np.log2(sync))
+		level[active] = np.maximum(getTimestepLevels( acc[active], dt, maxLevel, eta, softening ), lMin)
+
+	return nForce
+
+
+def getMortonKeys( pos, depth ):
+	"""
+	Get the Morton (Z-order) key of each particle inside its bounding cube
+	pos    is an N x 3 matrix of positions
+	depth  is the number of octree levels encoded in each key
+	keys   is an N vector of Morton keys
+	corner is the lower corner of the bounding cube
+	size   is the side length of the bounding cube
+	"""
+	corner = pos.min(0)
+	size = np.max(pos.max(0) - corner)
+	if size == 0:
+		size = 1.0
+	size *= 1.0 + 1e-9   # keep the far edge inside the cube
+
+	# integer cell coordinates on the finest level
+	cells = ((pos - corner) / size * 2**depth).astype(np.uint64)
+	cells = np.minimum(cells, np.uint64(2**depth - 1))
+
+	# interleave the bits of x, y, z
+	keys = np.zeros(pos.shape[0], dtype=np.uint64)
+	for b in range(depth):
+		for d in range(3):
+			bit = (cells[:,d] >> np.uint64(b)) & np.uint64(1)
+			keys |= bit << np.uint64(3*b + 2-d)
+
+	return keys, corner, size
+
+
+def buildOctree( pos, mass, leafSize=8, depth=21 ):
+	"""
+	Build a Barnes-Hut octree from Morton-sorted particles
+	pos      is an N x 3 matrix of positions
+	mass     is an N x 1 vector of masses
+	leafSize is the maximum number of particles in a leaf
+	depth    is the maximum depth of the tree
+	tree     is a dict of flat node arrays; every node owns the contiguous
+	         range start:end of the sorted particles, and its children are
+	         the nodes firstChild:firstChild+nChild
+	"""
+	N = pos.shape[0]
+	keys, corner, size = getMortonKeys( pos, depth )
+	order = np.argsort(keys, kind='stable')
+	keys = keys[order]
+
+	# finest boundaries between occupied cells found so far
+	cut = np.zeros(N+1, dtype=bool)
+	cut[0] = cut[N] = True
+
+	# level 0 is the root cell
+	starts = [np.array([0])]
+	ends   = [np.array([N])]
+	levels = [np.array([0])]
+	firstChild = []
+	nChild = []
+	nNodes = 1
+
+	for l in range(1, depth+1):
+		start, end = starts[-1], ends[-1]
+		split = np.flatnonzero(end - start > leafSize)
+		if split.size == 0:
+			break
+
+		# cell boundaries on this level
+		prefix = keys >> np.uint64(3*(depth-l))
+		cut[1:N][prefix[1:] != prefix[:-1]] = True
+		cutPos = np.flatnonzero(cut)
+
+		# particles that belong to a node being split
+		inSplit = np.zeros(N+1, dtype=int)
+		np.add.at(inSplit, start[split], 1)
+		np.add.at(inSplit, end[split], -1)
+		inSplit = np.cumsum(inSplit[:N]) > 0
+
+		# children are the cells of this level inside the split nodes
+		cStart = np.flatnonzero(cut[:N] & inSplit)
+		cEnd = cutPos[np.searchsorted(cutPos, cStart, side='right')]
+		parent = split[np.searchsorted(start[split], cStart, side='right') - 1]
+
+		count = np.bincount(parent, minlength=start.size)
+		first = np.full(start.size, -1)
+		first[split] = nNodes + np.searchsorted(parent, split)
+		firstChild.append(first)
+		nChild.append(count)
+
+		starts.append(cStart)
+		ends.append(cEnd)
+		levels.append(np.full(cStart.size, l))
+		nNodes += cStart.size
+
+	firstChild.append(np.full(starts[-1].size, -1))
+	nChild.append(np.zeros(starts[-1].size, dtype=int))
+
+	start = np.concatenate(starts)
+	end   = np.concatenate(ends)
+
+	# node masses and centres of mass from prefix sums over the sorted particles
+	p = pos[order]
+	m = mass[order,0]
+	cm = np.concatenate(([0.0], np.cumsum(m)))
+	cmr = np.vstack((np.zeros((1,3)), np.cumsum(m[:,None] * p, 0)))
+	cr = np.vstack((np.zeros((1,3)), np.cumsum(p, 0)))
+	nodeMass = cm[end] - cm[start]
+	com = (cr[end] - cr[start]) / (end - start)[:,None]
+	massive = nodeMass > 0
+	com[massive] = (cmr[end] - cmr[start])[massive] / nodeMass[massive,None]
+
+	tree = {
+		'order':      order,
+		'pos':        p,
+		'mass':       m,
+		'start':      start,
+		'end':        end,
+		'size':       size / 2.0**np.concatenate(levels),
+		'mass_node':  nodeMass,
+		'com':        com,
+		'firstChild': np.concatenate(firstChild),
+		'nChild':     np.concatenate(nChild),
+	}
+
+	return tree
+
+
+def getAccTree( pos, mass, G, softening, theta=0.5, leafSize=8, batch=4096 ):
+	"""
+	Calculate the acceleration on each particle with a Barnes-Hut octree
+	pos      is an N x 3 matrix of positions
+	mass     is an N x 1 vector of masses
+	G        is Newton's Gravitational constant
+	softening is the softening length, or an N vector of per-particle
+	         lengths (a pair then uses the mean of the squares)
+	theta    is the opening angle (theta = 0 recovers the direct sum)
+	leafSize is the maximum number of particles in a leaf
+	batch    is the number of particles walked through the tree at once
+	a        is N x 3 matrix of accelerations
+	"""
+	N = pos.shape[0]
+	tree = buildOctree( pos, mass, leafSize )
+	p, m = tree['pos'], tree['mass']
+	start, end = tree['start'], tree['end']
+	firstChild, nChild = tree['firstChild'], tree['nChild']
+	size2 = tree['size']**2
+	com, nodeMass = tree['com'], tree['mass_node']
+	eps2 = np.broadcast_to(np.asarray(softening, dtype=float)**2, (N,))[tree['order']]
+
+	a_sorted = np.zeros((N,3))
+
+	def addForce( pi, d, mj, soft2, b, nb ):
+		# G m_j (r_j - r_i) / (|r_j - r_i|^2 + softening^2)^(3/2), like getAcc
+		inv_r3 = np.einsum('ij,ij->i', d, d) + soft2
+		inv_r3[inv_r3>0] = inv_r3[inv_r3>0]**(-1.5)
+		w = G * mj * inv_r3
+		for k in range(3):
+			a_sorted[b:b+nb,k] += np.bincount(pi - b, weights=w*d[:,k], minlength=nb)
+
+	for b in range(0, N, batch):
+		nb = min(batch, N-b)
+
+		# (particle, node) pairs still to be visited, starting at the root
+		pi = np.arange(b, b+nb)
+		ni = np.zeros(nb, dtype=int)
+
+		while pi.size:
+			d = com[ni] - p[pi]
+			r2 = np.einsum('ij,ij->i', d, d)
+			inside = (start[ni] <= pi) & (pi < end[ni])
+			far = (size2[ni] < theta**2 * r2) & ~inside
+
+			# distant nodes act as a single point mass
+			idx = np.flatnonzero(far)
+			addForce( pi[idx], d[idx], nodeMass[ni[idx]], eps2[pi[idx]], b, nb )
+
+			# near leaves are summed directly, particle by particle
+			near = np.flatnonzero(~far)
+			pi, ni = pi[near], ni[near]
+			cnt = nChild[ni]
+			leaf = cnt == 0
+			lp, ln = pi[leaf], ni[leaf]
+			lcnt = end[ln] - start[ln]
+			pp = np.repeat(lp, lcnt)
+			jj = np.repeat(start[ln] - np.cumsum(lcnt) + lcnt, lcnt) + np.arange(lcnt.sum())
+			addForce( pp, p[jj] - p[pp], m[jj], 0.5*(eps2[pp] + eps2[jj]), b, nb )
+
+			# near internal nodes are opened
+			pi = np.repeat(pi, cnt)
+			ni = np.repeat(firstChild[ni] - np.cumsum(cnt) + cnt, cnt) + np.arange(cnt.sum())
+
+	# back to the original particle order
+	a = np.zeros((N,3))
+	a[tree['order']] = a_sorted
+
+	return a
+
+
+def getCICWeights( pos, boxSize, Ng ):
+	"""
+	Cloud-in-cell weights of each particle on a periodic grid
+	pos     is an N x 3 matrix of positions in [-boxSize/2, boxSize/2)
+	boxSize is the side length of the periodic box
+	Ng      is the number of grid cells per dimension
+	idx     is an 8 x N matrix of flat cell indices
+	w       is an 8 x N matrix of weights (summing to 1 for each particle)
+	"""
+	# cell coordinates relative to the cell centres
+	s = (pos + boxSize/2) / (boxSize/Ng) - 0.5
+	i0 = np.floor(s).astype(int)
+	f = s - i0
+
+	idx = np.zeros((8,pos.shape[0]), dtype=int)
+	w = np.ones((8,pos.shape[0]))
+	for c in range(8):
+		for d in range(3):
+			o = (c >> d) & 1
+			idx[c] = idx[c]*Ng + (i0[:,d] + o) % Ng
+			w[c] *= f[:,d] if o else 1.0 - f[:,d]
+
+	return idx, w
+
+
+def getAccPM( pos, mass, G, boxSize, Ng=64 ):
+	"""
+	Calculate the acceleration on each particle with a particle-mesh solver
+	in the periodic box [-boxSize/2, boxSize/2)^3
+	pos     is an N x 3 matrix of positions
+	mass    is an N x 1 vector of masses
+	G       is Newton's Gravitational constant
+	boxSize is the side length of the periodic box
+	Ng      is the number of grid cells per dimension (the grid sets the softening)
+	a       is N x 3 matrix of accelerations
+	"""
+	dx = boxSize / Ng
+
+	# deposit mass on the grid with CIC
+	idx, w = getCICWeights( pos, boxSize, Ng )
+	rho = np.bincount(idx.ravel(), weights=(w * mass[:,0]).ravel(), minlength=Ng**3)
+	rho = rho.reshape((Ng,Ng,Ng)) / dx**3
+
+	# Fourier Space Variables
+	klin = 2.0 * np.pi * np.fft.fftfreq(Ng, dx)
+	kx, ky, kz = np.meshgrid(klin, klin, klin[:Ng//2+1], indexing='ij')
+	kSq = kx**2 + ky**2 + kz**2
+	kSq_inv = np.zeros(kSq.shape)
+	kSq_inv[kSq>0] = 1.0 / kSq[kSq>0]   # drop the mean density (periodic box)
+
+	# solve the Poisson equation  del^2 Phi = 4 pi G rho
+	Phi_hat = -4.0 * np.pi * G * np.fft.rfftn( rho ) * kSq_inv
+
+	# acceleration -grad(Phi) on the grid, interpolated back to the particles with CIC
+	a = np.zeros((pos.shape[0],3))
+	for d, k in enumerate((kx, ky, kz)):
+		g = np.fft.irfftn( -1j * k * Phi_hat, s=(Ng,Ng,Ng) ).ravel()
+		a[:,d] = np.sum( w * g[idx], 0 )
+
+	return a
+
+
+def getAccBy( method, pos, mass, G, softening, **kwargs ):
+	"""
+	Calculate the accelerations with the chosen force solver
+	method is 'direct' for the exact pairwise sum (getAcc),
+	       'tiled' for the memory-bounded direct sum (getAccTiled),
+	       'tree' for the Barnes-Hut octree (getAccTree)
+	       or 'pm' for the periodic particle-mesh solver (getAccPM)
+	kwargs are passed on to the solver (e.g. theta)
+	a      is N x 3 matrix of accelerations
+	"""
+	if method == 'direct':
+		return getAcc( pos, mass, G, softening )
+	if method == 'tiled':
+		return getAccTiled( pos, mass, G, softening, **kwargs )
+	if method == 'tree':
+		return getAccTree( pos, mass, G, softening, **kwargs )
+	if method == 'pm':
+		return getAccPM( pos, mass, G, **kwargs )
+	raise ValueError(f"unknown force method '{method}'")
+	
+
+def getGroups( pos, mass, linkingLength, minMembers=8, boxSize=None ):
+	"""
+	Find friends-of-friends groups: particles closer than the linking length
+	are linked, and groups are the connected sets of linked particles
+	pos      is an N x 3 matrix of positions
+	mass     is an N x 1 vector of masses
+	linkingLength is the linking length
+	minMembers is the smallest number of particles that counts as a group
+	boxSize  is the side of the periodic box [-boxSize/2, boxSize/2) (None: open)
+	label    is an N vector with the group of each particle (-1: no group)
+	groupMass is a vector of group masses, most massive first
+	groupCom is a matrix of group centres of mass
+	"""
+	N = pos.shape[0]
+
+	# linked pairs from a KD-tree, so the cost grows as N log N rather than N^2
+	if boxSize is None:
+		tree = cKDTree( pos )
+	else:
+		tree = cKDTree( (pos + boxSize/2) % boxSize, boxsize=boxSize )
+	pairs = tree.query_pairs( linkingLength, output_type='ndarray' )
+	links = coo_matrix( (np.ones(len(pairs)), (pairs[:,0], pairs[:,1])), shape=(N,N) )
+	_, comp = connected_components( links, directed=False )
+
+	# keep the components with enough members, ordered by mass
+	count = np.bincount(comp)
+	compMass = np.bincount(comp, weights=mass[:,0])
+	keep = np.flatnonzero(count >= minMembers)
+	keep = keep[np.argsort(-compMass[keep], kind='stable')]
+	groupOf = np.full(count.size, -1)
+	groupOf[keep] = np.arange(keep.size)
+	label = groupOf[comp]
+	groupMass = compMass[keep]
+
+	# centres of mass, measured from one member so groups across the periodic boundary stay whole
+	member = label >= 0
+	first = np.zeros(keep.size, dtype=int)
+	first[label[member][::-1]] = np.flatnonzero(member)[::-1]
+	d = pos[member] - pos[first[label[member]]]
+	if boxSize is not None:
+		d -= boxSize * np.round(d / boxSize)
+	groupCom = np.zeros((keep.size,3))
+	for k in range(3):
+		groupCom[:,k] = np.bincount(label[member], weights=mass[member,0]*d[:,k], minlength=keep.size)
+	groupCom = pos[first] + groupCom / groupMass[:,None]
+	if boxSize is not None:
+		groupCom = (groupCom + boxSize/2) % boxSize - boxSize/2
+
+	return label, groupMass, groupCom
+
+
 def getEnergy( pos, vel, mass, G ):
 	"""
 	Get kinetic energy (KE) and potential energy (PE) of simulation
@@ -69,6 +597,138 @@ def getEnergy( pos, vel, mass, G ):
 	return KE, PE;
 
 
+def runEnsemble( seeds, N=100, tEnd=10.0, dt=0.01, softening=0.1, G=1.0, energyEvery=10, x64=True ):
+	"""
+	Integrate many independent N-body systems in one call with JAX
+	seeds     is a list of random seeds, one system per seed; initial
+	          conditions are drawn exactly as in main()
+	N, tEnd, dt, softening, G are the simulation parameters of main()
+	energyEvery is the number of leapfrog steps between energy samples
+	          (the run is ceil(tEnd/dt) steps, as in main(), rounded down
+	          to a multiple of it)
+	x64       runs in double precision (float32 otherwise)
+	t         is a vector of the sample times
+	KE, PE    are len(seeds) x len(t) matrices of energy histories
+	The whole integration is jitted and vmapped over the systems; if JAX
+	sees several CPU devices (e.g. XLA_FLAGS=--xla_force_host_platform_device_count=8)
+	the batch is also split across them with pmap.
+	"""
+	import jax
+	import jax.numpy as jnp
+	from jax.experimental import enable_x64
+
+	nOut = int(np.ceil(tEnd/dt)) // energyEvery
+	S = len(seeds)
+
+	# same initial conditions as main() for each seed
+	mass = 20.0*np.ones((N,1))/N
+	pos0 = np.zeros((S,N,3))
+	vel0 = np.zeros((S,N,3))
+	for s, seed in enumerate(seeds):
+		rng = np.random.RandomState(seed)
+		pos0[s] = rng.randn(N,3)
+		vel0[s] = rng.randn(N,3)
+	vel0 -= np.mean(mass * vel0,1,keepdims=True) / np.mean(mass)
+
+	def acc( pos, m ):
+		# same pairwise sum as getAcc
+		d = pos[None,:,:] - pos[:,None,:]
+		r2 = jnp.sum(d**2, -1) + softening**2
+		inv_r3 = jnp.where(r2>0, r2, 1.0)**(-1.5) * (r2>0)
+		return G * jnp.einsum('ijk,ij,j->ik', d, inv_r3, m[:,0])
+
+	def energy( pos, vel, m ):
+		# same as getEnergy
+		KE = 0.5 * jnp.sum( m * vel**2 )
+		r = jnp.sqrt(jnp.sum((pos[None,:,:] - pos[:,None,:])**2, -1))
+		inv_r = jnp.where(r>0, 1.0/jnp.where(r>0, r, 1.0), 0.0)
+		PE = -0.5 * G * jnp.sum( (m*m.T) * inv_r )
+		return KE, PE
+
+	def simulate( pos, vel, m ):
+		def kdk( i, state ):
+			pos, vel, a = state
+			vel = vel + a * dt/2.0
+			pos = pos + vel * dt
+			a = acc( pos, m )
+			vel = vel + a * dt/2.0
+			return pos, vel, a
+
+		def block( state, _ ):
+			state = jax.lax.fori_loop( 0, energyEvery, kdk, state )
+			return state, energy( state[0], state[1], m )
+
+		E0 = energy( pos, vel, m )
+		_, (KE, PE) = jax.lax.scan( block, (pos, vel, acc(pos, m)), None, length=nOut )
+		return jnp.concatenate((E0[0][None], KE)), jnp.concatenate((E0[1][None], PE))
+
+	with enable_x64(x64):
+		dtype = jnp.float64 if x64 else jnp.float32
+		m = jnp.asarray(mass, dtype)
+		run = jax.vmap( simulate, in_axes=(0,0,None) )
+
+		nDev = jax.local_device_count()
+		if nDev > 1 and S > 1:
+			# pad the batch so it splits evenly over the devices
+			pad = -S % nDev
+			pos0 = np.concatenate((pos0, np.repeat(pos0[:1], pad, 0)))
+			vel0 = np.concatenate((vel0, np.repeat(vel0[:1], pad, 0)))
+			split = lambda x: jnp.asarray(x.reshape((nDev, -1) + x.shape[1:]), dtype)
+			KE, PE = jax.pmap( run, in_axes=(0,0,None) )( split(pos0), split(vel0), m )
+			KE = np.asarray(KE).reshape(-1, nOut+1)[:S]
+			PE = np.asarray(PE).reshape(-1, nOut+1)[:S]
+		else:
+			KE, PE = jax.jit(run)( jnp.asarray(pos0, dtype), jnp.asarray(vel0, dtype), m )
+			KE, PE = np.asarray(KE), np.asarray(PE)
+
+	t = np.arange(nOut+1) * energyEvery * dt
+
+	return t, KE, PE
+
+
+class TrajectoryWriter:
+	"""
+	Stream snapshots of the simulation into memory-mapped .npy files, so the
+	full history never has to be held in RAM
+	path   is the output file for positions, an nSnap x N x 3 array;
+	       time, KE and PE go to an nSnap x 3 array next to it (*_energy.npy)
+	N      is the number of particles
+	nSnap  is the number of snapshots that will be written
+	chunk  is the number of snapshots buffered in RAM between flushes
+	"""
+
+	def __init__( self, path, N, nSnap, chunk=32 ):
+		root, _ = os.path.splitext(path)
+		self.pos = np.lib.format.open_memmap(path, mode='w+', dtype=np.float64, shape=(nSnap,N,3))
+		self.energy = np.lib.format.open_memmap(root + '_energy.npy', mode='w+', dtype=np.float64, shape=(nSnap,3))
+		self.pos_buf = np.zeros((chunk,N,3))
+		self.energy_buf = np.zeros((chunk,3))
+		self.nBuf = 0   # snapshots waiting in the buffer
+		self.nOut = 0   # snapshots already on disk
+
+	def append( self, pos, t, KE, PE ):
+		""" add one snapshot, flushing the buffer to disk when it is full """
+		self.pos_buf[self.nBuf] = pos
+		self.energy_buf[self.nBuf] = t, KE, PE
+		self.nBuf += 1
+		if self.nBuf == self.pos_buf.shape[0]:
+			self.flush()
+
+	def flush( self ):
+		""" write the buffered snapshots to disk in one contiguous block """
+		n0, n1 = self.nOut, self.nOut + self.nBuf
+		self.pos[n0:n1] = self.pos_buf[:self.nBuf]
+		self.energy[n0:n1] = self.energy_buf[:self.nBuf]
+		self.pos.flush()
+		self.energy.flush()
+		self.nOut = n1
+		self.nBuf = 0
+
+	def close( self ):
+		self.flush()
+		del self.pos, self.energy
+
+
 def main():
 	""" N-body simulation """
 	
@@ -79,8 +739,31 @@ def main():
 	dt        = 0.01   # timestep
 	softening = 0.1    # softening length
 	G         = 1.0    # Newton's Gravitational Constant
+	method    = 'direct' # force solver: 'direct', 'tiled' direct sum, Barnes-Hut 'tree' or particle-mesh 'pm'
+	theta     = 0.5    # Barnes-Hut opening angle (tree method only)
+	boxSize   = 8.0    # side length of the periodic box (pm method only)
+	Ng        = 64     # particle-mesh cells per dimension (pm method only)
+	maxLevel  = 0      # block timestep levels below dt (0: one global timestep; direct/tiled only)
+	eta       = 0.2    # block timestep accuracy parameter
+	energyEvery = 0    # compute energy diagnostics every energyEvery steps (0: every step for
+	                   # direct/tiled, whose sweep gives PE for free, every 20 for tree/pm, which
+	                   # need an extra O(N^2) potential sweep)
+	trailLength = 50   # number of past steps drawn as particle trails
+	outFile   = None   # .npy file to stream snapshots to (None: no output)
+	saveEvery = 10     # write a snapshot every saveEvery steps
+	fofEvery  = 0      # run the friends-of-friends group finder every fofEvery steps (0: off); saved to *_groups.npz
+	linkingLength = 0.2 # friends-of-friends linking length
+	minMembers = 5     # smallest friends-of-friends group
 	plotRealTime = True # switch on for plotting as the simulation goes along
 	
+	# block timesteps evaluate forces on the active particles only, which the
+	# direct sum can do; the tree and the periodic mesh always solve for everyone
+	if maxLevel > 0 and method not in ('direct', 'tiled'):
+		raise ValueError(f"block timesteps (maxLevel > 0) need method 'direct' or 'tiled', not '{method}'")
+	
+	if energyEvery == 0:
+		energyEvery = 1 if method in ('direct', 'tiled') else 20
+	
 	# Generate Initial Conditions
 	np.random.seed(17)            # set the random number generator seed
 	
@@ -92,20 +775,45 @@ def main():
 	vel -= np.mean(mass * vel,0) / np.mean(mass)
 	
 	# calculate initial gravitational accelerations
-	acc = getAcc( pos, mass, G, softening )
+	solverOpts = {}
+	if method == 'tree':
+		solverOpts = {'theta': theta}
+	elif method == 'pm':
+		solverOpts = {'boxSize': boxSize, 'Ng': Ng}
+	acc = getAccBy( method, pos, mass, G, softening, **solverOpts )
 	
-	# calculate initial energy of system
-	KE, PE  = getEnergy( pos, vel, mass, G )
+	# calculate initial energy of system (tiled, so no N x N matrices are built)
+	KE = 0.5 * np.sum( mass * vel**2 )
+	PE = getPotentialEnergy( pos, mass, G )
+	
+	# pairwise solvers get the potential energy from the same sweep as the forces
+	fusedEnergy = method in ('direct', 'tiled') and maxLevel == 0
+	
+	# timestep levels for block timesteps (uses the direct sum on active particles)
+	level = getTimestepLevels( acc, dt, maxLevel, eta, softening )
+	nForce = 0
 	
 	# number of timesteps
 	Nt = int(np.ceil(tEnd/dt))
 	
-	# save energies, particle orbits for plotting trails
-	pos_save = np.zeros((N,3,Nt+1))
-	pos_save[:,:,0] = pos
-	KE_save = np.zeros(Nt+1)
+	# ring buffer with the most recent positions for plotting trails
+	trail = np.zeros((trailLength+1,N,3))
+	trail[0] = pos
+	nTrail = 1
+	
+	# stream snapshots to disk instead of keeping every step in RAM
+	writer = None
+	if outFile is not None:
+		writer = TrajectoryWriter( outFile, N, Nt//saveEvery + 1 )
+		writer.append( pos, t, KE, PE )
+	
+	# friends-of-friends group time series: (t, group masses, centres of mass)
+	groups_save = []
+	
+	# save energies for plotting
+	KE_save = np.full(Nt+1, np.nan)   # NaN on steps without diagnostics
 	KE_save[0] = KE
-	PE_save = np.zeros(Nt+1)
+	PE_save = np.full(Nt+1, np.nan)
 	PE_save[0] = PE
 	t_all = np.arange(Nt+1)*dt
 	
@@ -117,35 +825,63 @@ def main():
 	
 	# Simulation Main Loop
 	for i in range(Nt):
-		# (1/2) kick
-		vel += acc * dt/2.0
+		save = writer is not None and (i+1) % saveEvery == 0
+		diagnose = ((i+1) % energyEvery == 0) or (i == Nt-1) or save
 		
-		# drift
-		pos += vel * dt
-		
-		# update accelerations
-		acc = getAcc( pos, mass, G, softening )
-		
-		# (1/2) kick
-		vel += acc * dt/2.0
+		if maxLevel > 0:
+			# kick/drift/kick on the block timestep hierarchy
+			nForce += blockStep( pos, vel, acc, mass, G, softening, dt, level, maxLevel, eta )
+		else:
+			# (1/2) kick
+			vel += acc * dt/2.0
+			
+			# drift
+			pos += vel * dt
+			if method == 'pm':
+				pos[:] = (pos + boxSize/2) % boxSize - boxSize/2   # periodic boundaries
+			
+			# update accelerations (and the potential energy on diagnostic steps)
+			if diagnose and fusedEnergy:
+				acc, PE = getAccPot( pos, mass, G, softening )
+			else:
+				acc = getAccBy( method, pos, mass, G, softening, **solverOpts )
+			nForce += N
+			
+			# (1/2) kick
+			vel += acc * dt/2.0
 		
 		# update time
 		t += dt
 		
 		# get energy of system
-		KE, PE  = getEnergy( pos, vel, mass, G )
+		if diagnose:
+			KE = 0.5 * np.sum( mass * vel**2 )
+			if not fusedEnergy:
+				# other solvers need a separate, memory-bounded potential energy sweep
+				PE = getPotentialEnergy( pos, mass, G )
+			KE_save[i+1] = KE
+			PE_save[i+1] = PE
 		
-		# save energies, positions for plotting trail
-		pos_save[:,:,i+1] = pos
-		KE_save[i+1] = KE
-		PE_save[i+1] = PE
+		# save positions for plotting trail
+		trail[(i+1) % trail.shape[0]] = pos
+		nTrail = min(nTrail+1, trail.shape[0])
+		
+		# save snapshot
+		if save:
+			writer.append( pos, t, KE_save[i+1], PE_save[i+1] )
+		
+		# find groups
+		if fofEvery > 0 and (i+1) % fofEvery == 0:
+			_, groupMass, groupCom = getGroups( pos, mass, linkingLength, minMembers, boxSize if method == 'pm' else None )
+			groups_save.append( (t, groupMass, groupCom) )
+			print(f"t = {t:.2f}: {len(groupMass)} groups" + (f", largest mass {groupMass[0]:.3g} at {np.round(groupCom[0], 3)}" if len(groupMass) else ""))
 		
 		# plot in real time
 		if plotRealTime or (i == Nt-1):
 			plt.sca(ax1)
 			plt.cla()
-			xx = pos_save[:,0,max(i-50,0):i+1]
-			yy = pos_save[:,1,max(i-50,0):i+1]
+			xx = trail[:nTrail,:,0]
+			yy = trail[:nTrail,:,1]
 			plt.scatter(xx,yy,s=1,color=[.7,.7,1])
 			plt.scatter(pos[:,0],pos[:,1],s=10,color='blue')
 			ax1.set(xlim=(-2, 2), ylim=(-2, 2))
@@ -165,6 +901,22 @@ def main():
 	    
 	
 	
+	if writer is not None:
+		writer.close()
+	
+	# group time series, flattened: the groups of snapshot k are rows
+	# sum(count[:k]) to sum(count[:k+1]) of mass and com
+	if groups_save:
+		groupFile = os.path.splitext(outFile)[0] + '_groups.npz' if outFile is not None else 'n_body_groups.npz'
+		np.savez( groupFile,
+		          t = np.array([g[0] for g in groups_save]),
+		          count = np.array([len(g[1]) for g in groups_save]),
+		          mass = np.concatenate([g[1] for g in groups_save]),
+		          com = np.concatenate([np.reshape(g[2], (-1,3)) for g in groups_save]) )
+	
+	if maxLevel > 0:
+		print(f"force evaluations per particle and step: {nForce / (N*Nt):.2f}")
+	
 	# add labels/legend
 	plt.sca(ax2)
 	plt.xlabel('time')
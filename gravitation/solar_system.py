@@ -1,5 +1,8 @@
+import hashlib
+import os
+import time
 import pygame
-import math
+import numpy as np
 
 pygame.init()
 WIDTH, HEIGHT = pygame.display.Info().current_w, pygame.display.Info().current_h
@@ -15,47 +18,408 @@ COLOR_JUPITER = (216, 202, 157)
 COLOR_SATURN = (191, 189, 175)
 COLOR_URANUS = (209, 231, 231)
 COLOR_NEPTUNE = (63, 84, 186)
+COLOR_ASTEROID = (140, 140, 140)
 FONT_1 = pygame.font.SysFont("Trebuchet MS", 21)
 FONT_2 = pygame.font.SysFont("Trebuchet MS", 16)
 pygame.display.set_caption("Solar System Simulation")
 BG = pygame.transform.scale(pygame.image.load("gravitation/assets/background.jpg"), (WIDTH, HEIGHT))
+N_ASTEROIDS = 2000  # massless test particles in the asteroid belt
+
+
+# 4th-order Yoshida composition of the drift-kick-drift leapfrog
+YOSHIDA_W1 = 1 / (2 - 2 ** (1 / 3))
+YOSHIDA_W0 = -2 ** (1 / 3) / (2 - 2 ** (1 / 3))
+YOSHIDA_C = (YOSHIDA_W1 / 2, (YOSHIDA_W0 + YOSHIDA_W1) / 2, (YOSHIDA_W0 + YOSHIDA_W1) / 2, YOSHIDA_W1 / 2)
+YOSHIDA_D = (YOSHIDA_W1, YOSHIDA_W0, YOSHIDA_W1, 0)
+INTEGRATORS = ['euler', 'yoshida4', 'wisdom-holman']
+# default step of each integrator in days; Wisdom-Holman solves the orbit around the sun exactly,
+# so it keeps yoshida4's energy drift at a step several times longer
+INTEGRATOR_STEPS = {'euler': 2, 'yoshida4': 2, 'wisdom-holman': 16}
+MIN_STEP, MAX_STEP = 1 / 4, 32  # range of the step size control, in days
+
+
+def stumpff(z):
+    # Stumpff functions C(z) and S(z), with series near z = 0
+    c = np.empty_like(z)
+    s = np.empty_like(z)
+    pos, neg, small = z > 1e-6, z < -1e-6, np.abs(z) <= 1e-6
+    sz = np.sqrt(z[pos])
+    c[pos] = (1 - np.cos(sz)) / z[pos]
+    s[pos] = (sz - np.sin(sz)) / sz ** 3
+    sz = np.sqrt(-z[neg])
+    c[neg] = (np.cosh(sz) - 1) / -z[neg]
+    s[neg] = (np.sinh(sz) - sz) / sz ** 3
+    c[small] = 1 / 2 - z[small] / 24
+    s[small] = 1 / 6 - z[small] / 120
+    return c, s
+
+
+def kepler_drift(q, v, mu, dt):
+    # exact two-body motion of every body around a central mass, with universal variables
+    r0 = np.hypot(q[:, 0], q[:, 1])
+    vr0 = np.sum(q * v, 1) / r0
+    alpha = 2 / r0 - np.sum(v ** 2, 1) / mu
+    sqrt_mu = np.sqrt(mu)
+
+    # solve the universal Kepler equation for chi with Newton's method
+    chi = sqrt_mu * np.abs(alpha) * dt
+    for _ in range(50):
+        z = alpha * chi ** 2
+        c, s = stumpff(z)
+        r = chi ** 2 * c + r0 * vr0 / sqrt_mu * chi * (1 - z * s) + r0 * (1 - z * c)
+        f = r0 * vr0 / sqrt_mu * chi ** 2 * c + (1 - alpha * r0) * chi ** 3 * s + r0 * chi - sqrt_mu * dt
+        delta = f / r
+        chi -= delta
+        if np.all(np.abs(delta) <= 1e-12 * np.maximum(np.abs(chi), 1e-30)):
+            break
+
+    # Lagrange f and g coefficients
+    z = alpha * chi ** 2
+    c, s = stumpff(z)
+    f = 1 - chi ** 2 / r0 * c
+    g = dt - chi ** 3 * s / sqrt_mu
+    q_new = f[:, None] * q + g[:, None] * v
+    r = np.hypot(q_new[:, 0], q_new[:, 1])
+    f_dot = sqrt_mu / (r * r0) * (alpha * chi ** 3 * s - chi)
+    g_dot = 1 - chi ** 2 / r * c
+    v_new = f_dot[:, None] * q + g_dot[:, None] * v
+    return q_new, v_new
+
+
+class SolarSystem:
+    """Struct-of-arrays state of every body: masses, positions and velocities.
+    Bodies with zero mass are test particles: they feel the massive bodies but do not pull on anything."""
+
+    def __init__(self, G):
+        self.G = G
+        self.mass = np.zeros(0)
+        self.pos = np.zeros((0, 2))
+        self.vel = np.zeros((0, 2))
+        self.sun = None  # index of the sun, for distances and the Wisdom-Holman map
+        self.integrator = 'euler'  # one of INTEGRATORS
+
+    def add_bodies(self, pos, vel, mass):
+        # returns the indices of the new bodies
+        start = len(self.mass)
+        self.pos = np.vstack((self.pos, np.reshape(pos, (-1, 2))))
+        self.vel = np.vstack((self.vel, np.reshape(vel, (-1, 2))))
+        self.mass = np.concatenate((self.mass, np.ravel(mass).astype(float)))
+        return np.arange(start, len(self.mass))
+
+    def add_ring(self, n, r_min, r_max, seed=0):
+        # massless test particles on circular orbits around the sun, e.g. an asteroid belt
+        rng = np.random.default_rng(seed)
+        r = rng.uniform(r_min, r_max, n)
+        phi = rng.uniform(0, 2 * np.pi, n)
+        v = np.sqrt(self.G * self.mass[self.sun] / r)
+        direction = np.column_stack((np.cos(phi), np.sin(phi)))
+        pos = self.pos[self.sun] + r[:, None] * direction
+        vel = self.vel[self.sun] + v[:, None] * np.column_stack((-direction[:, 1], direction[:, 0]))
+        return self.add_bodies(pos, vel, np.zeros(n))
+
+    def accelerations(self, pos):
+        # pull of every massive body on every body, in one vectorised pass
+        massive = np.flatnonzero(self.mass > 0)
+        d = pos[None, massive, :] - pos[:, None, :]
+        r2 = np.sum(d ** 2, -1)
+        inv_r3 = np.zeros(r2.shape)
+        inv_r3[r2 > 0] = r2[r2 > 0] ** -1.5
+        return self.G * np.einsum('ijk,ij,j->ik', d, inv_r3, self.mass[massive])
+
+    def step(self, dt):
+        # advance every body by dt with the selected integrator
+        if self.integrator == 'euler':
+            # F = ma and a = F/m and a = dv/dt and dv = a * dt, for all bodies at once
+            self.vel += self.accelerations(self.pos) * dt
+            self.pos += self.vel * dt
+        elif self.integrator == 'yoshida4':
+            for c, d in zip(YOSHIDA_C, YOSHIDA_D):
+                self.pos += self.vel * c * dt
+                if d:
+                    self.vel += self.accelerations(self.pos) * d * dt
+        elif self.integrator == 'wisdom-holman':
+            self.wisdom_holman_step(dt)
+        else:
+            raise ValueError(f"unknown integrator '{self.integrator}'")
+
+    def wisdom_holman_step(self, dt):
+        # Wisdom-Holman map in democratic heliocentric coordinates: the Kepler orbit around the sun
+        # is solved exactly, so only the small planet-planet interactions are integrated
+        s = self.sun
+        others = np.arange(len(self.mass)) != s
+        m = self.mass[others]
+        m_sun = self.mass[s]
+        m_total = m_sun + np.sum(m)
+        com_pos = (m_sun * self.pos[s] + m @ self.pos[others]) / m_total
+        com_vel = (m_sun * self.vel[s] + m @ self.vel[others]) / m_total
+
+        # heliocentric positions, barycentric velocities
+        q = self.pos[others] - self.pos[s]
+        v = self.vel[others] - com_vel
+
+        def kick(q, v, h):
+            # planet-planet interactions (without the sun)
+            massive = np.flatnonzero(m > 0)
+            d = q[None, massive, :] - q[:, None, :]
+            r2 = np.sum(d ** 2, -1)
+            inv_r3 = np.zeros(r2.shape)
+            inv_r3[r2 > 0] = r2[r2 > 0] ** -1.5
+            return v + h * self.G * np.einsum('ijk,ij,j->ik', d, inv_r3, m[massive])
+
+        def sun_drift(q, v, h):
+            # the sun's motion around the barycentre
+            return q + h * (m @ v) / m_sun
+
+        v = kick(q, v, dt / 2)
+        q = sun_drift(q, v, dt / 2)
+        q, v = kepler_drift(q, v, self.G * m_sun, dt)
+        q = sun_drift(q, v, dt / 2)
+        v = kick(q, v, dt / 2)
+
+        # back to positions and velocities of all bodies
+        com_pos += com_vel * dt
+        self.pos[s] = com_pos - (m @ q) / m_total
+        self.pos[others] = q + self.pos[s]
+        self.vel[others] = v + com_vel
+        self.vel[s] = com_vel - (m @ v) / m_sun
+
+    def energy(self):
+        # kinetic plus potential energy of the massive bodies
+        massive = self.mass > 0
+        m, pos, vel = self.mass[massive], self.pos[massive], self.vel[massive]
+        kinetic = 0.5 * np.sum(m * np.sum(vel ** 2, 1))
+        i, j = np.triu_indices(len(m), 1)
+        potential = -self.G * np.sum(m[i] * m[j] / np.hypot(*(pos[i] - pos[j]).T))
+        return kinetic + potential
+
+    def distance_to_sun(self, index):
+        return np.hypot(*(self.pos[index] - self.pos[self.sun]))
+
+    def copy(self):
+        system = SolarSystem(self.G)
+        system.add_bodies(self.pos, self.vel, self.mass)
+        system.sun = self.sun
+        system.integrator = self.integrator
+        return system
+
+
+class Ephemeris:
+    """Positions and velocities of a SolarSystem saved every `every` steps of `dt`, as float32.
+    The table is cached on disk and keyed by the initial state and integrator settings, so it is
+    integrated only once, a few samples per frame through build(). Playback Hermite-interpolates
+    between saved samples instead of stepping, which makes seeking to any time as cheap as the next frame."""
+    CACHE_DIR = "gravitation/ephemerides"
+
+    def __init__(self, system, dt, years=50, every=5):
+        self.dt = dt
+        self.every = every
+        self.interval = dt * every
+        self.n = int(years * 365.25 * 60 * 60 * 24 / self.interval) + 1
+        key = hashlib.sha1()
+        for array in (system.mass, system.pos, system.vel):
+            key.update(np.ascontiguousarray(array, dtype=np.float64).tobytes())
+        key.update(repr((system.G, system.sun, system.integrator, dt, every, self.n)).encode())
+        self.path = os.path.join(self.CACHE_DIR, key.hexdigest()[:16] + ".npy")
+        self.duration = (self.n - 1) * self.interval
+        self.built = 0  # samples integrated so far
+        self.system = self.partial = self.states = None
+        if os.path.exists(self.path):
+            self.states = np.load(self.path, mmap_mode='r')  # (sample, pos/vel, body, xy)
+            self.built = self.n
+        else:
+            os.makedirs(self.CACHE_DIR, exist_ok=True)
+            self.system = system.copy()
+            self.partial = np.lib.format.open_memmap(self.path + ".part", 'w+', np.float32,
+                                                     (self.n, 2) + system.pos.shape)
+
+    @property
+    def ready(self):
+        return self.states is not None
+
+    @property
+    def progress(self):
+        return self.built / self.n
+
+    def build(self, budget):
+        # integrates samples until `budget` seconds are used and returns True once the table is complete
+        start = time.perf_counter()
+        while not self.ready and time.perf_counter() - start < budget:
+            self.partial[self.built, 0] = self.system.pos
+            self.partial[self.built, 1] = self.system.vel
+            self.built += 1
+            if self.built < self.n:
+                for _ in range(self.every):
+                    self.system.step(self.dt)
+                continue
+            self.partial.flush()
+            self.partial = self.system = None
+            os.replace(self.path + ".part", self.path)  # a build interrupted half way is never picked up as a cache
+            self.states = np.load(self.path, mmap_mode='r')
+        return self.ready
+
+    def cancel(self):
+        # drops an unfinished build together with its .part file
+        if self.partial is not None:
+            self.partial = self.system = None
+            os.remove(self.path + ".part")
+
+    def state(self, t):
+        # cubic Hermite interpolation of positions (and its derivative for velocities) at time t
+        t = min(max(t, 0), self.duration)
+        k = min(int(t // self.interval), len(self.states) - 2)
+        s = t / self.interval - k
+        h = self.interval
+        (p0, v0), (p1, v1) = self.states[k].astype(float), self.states[k + 1].astype(float)
+        pos = ((2 * s ** 3 - 3 * s ** 2 + 1) * p0 + (s ** 3 - 2 * s ** 2 + s) * h * v0 +
+               (-2 * s ** 3 + 3 * s ** 2) * p1 + (s ** 3 - s ** 2) * h * v1)
+        vel = ((6 * s ** 2 - 6 * s) * (p0 - p1) / h + (3 * s ** 2 - 4 * s + 1) * v0 +
+               (3 * s ** 2 - 2 * s) * v1)
+        return pos, vel
+
+
+class OrbitTrail:
+    """Ring buffer with the last `length` orbit points, recorded every `every` steps.
+    Points are written twice, at i and i + length, so the trail is always one contiguous slice;
+    their screen projection is cached and only recomputed when the zoom or pan changes."""
+
+    def __init__(self, length, every=1):
+        self.length = length
+        self.every = every
+        self.world = np.zeros((2 * length, 2))
+        self.screen = np.zeros((2 * length, 2))
+        self.head = 0  # slot of the newest point
+        self.count = 0
+        self.steps = 0
+        self.view = None  # (scale, offset) the screen points were projected with
+
+    def append(self, x, y):
+        self.steps += 1
+        if self.steps % self.every:
+            return
+        self.head = (self.head + 1) % self.length
+        self.count = min(self.count + 1, self.length)
+        slots = [self.head, self.head + self.length]
+        self.world[slots] = x, y
+        if self.view is not None:
+            scale, offset = self.view
+            self.screen[slots] = self.world[self.head] * scale + offset
+
+    def __len__(self):
+        return self.count
+
+    def clear(self):
+        self.count = 0
+
+    def points(self, scale, offset):
+        # oldest to newest, in screen coordinates
+        if self.view != (scale, offset):
+            self.screen[:] = self.world * scale + offset
+            self.view = (scale, offset)
+        start = self.head + self.length - self.count + 1
+        return self.screen[start:start + self.count]
+
+
+class TimeWarp:
+    """Fixed-step accumulator: wall-clock time multiplied by the warp factor is paid out in whole
+    physics steps of `dt`. Warp 1 is the old one step per frame at 60 FPS. Stepping stops once
+    `budget` seconds of the frame are used, and the backlog is dropped rather than carried over."""
+
+    def __init__(self, dt, warp=1, budget=1 / 80):
+        self.dt = dt
+        self.warp = warp
+        self.budget = budget
+        self.accumulator = 0
+        self.steps = 0
+        self.steps_per_second = 0
+        self.window_start = time.perf_counter()
+
+    @property
+    def days_per_second(self):
+        return self.steps_per_second * self.dt / (60 * 60 * 24)
+
+    def scale(self, factor):
+        self.warp = min(max(self.warp * factor, 1 / 8), 4096)
+
+    def advance(self, step, wall_dt):
+        # runs step() as many times as the elapsed wall time calls for and returns the count
+        start = time.perf_counter()
+        self.accumulator += wall_dt * 60 * self.warp * self.dt
+        n = 0
+        while self.accumulator >= self.dt:
+            step()
+            self.accumulator -= self.dt
+            n += 1
+            if time.perf_counter() - start > self.budget:
+                self.accumulator = min(self.accumulator, self.dt)
+                break
+        self.steps += n
+        elapsed = time.perf_counter() - self.window_start
+        if elapsed > 0.5:
+            self.steps_per_second = self.steps / elapsed
+            self.steps = 0
+            self.window_start = time.perf_counter()
+        return n
+
+    def reset(self):
+        self.accumulator = 0
+
+
+def state_view(array, column):
+    # property that reads and writes one column of a SolarSystem state array
+    def get(self):
+        return getattr(self.system, array)[self.index, column]
+
+    def set(self, value):
+        getattr(self.system, array)[self.index, column] = value
+
+    return property(get, set)
 
 
 class Planet:
     AU = 149.6e6 * 1000  # Astronomical unit
     G = 6.67428e-11  # Gravitational constant
-    TIMESTEP = 60 * 60 * 24 * 2  # Seconds in 2 days
+    TIMESTEP = 60 * 60 * 24 * 2  # Seconds in 2 days, changed with the integrator and the - / = keys
     SCALE = 200 / AU
+    TRAIL_LENGTH = 2000  # orbit points kept per planet
+    TRAIL_EVERY = 2  # record an orbit point every TRAIL_EVERY steps
+    system = SolarSystem(G)  # shared state that every planet is a view onto
 
     def __init__(self, x, y, radius, color, mass):
         # x, y -> position of planets on the screen
         # mass in KG
-        self.x = x
-        self.y = y
+        self.index = self.system.add_bodies((x, y), (0, 0), mass)[0]
         self.radius = radius
         self.color = color
-        self.mass = mass
-        self.orbit = []
-        self.sun = False  # tells if the planet is sun or not
+        self.orbit = OrbitTrail(self.TRAIL_LENGTH, self.TRAIL_EVERY)
+
+    # position, velocity and mass live in the shared state arrays
+    x = state_view('pos', 0)
+    y = state_view('pos', 1)
+    x_vel = state_view('vel', 0)
+    y_vel = state_view('vel', 1)
+    mass = property(lambda self: self.system.mass[self.index])
+
+    @property
+    def sun(self):
+        # tells if the planet is sun or not
         # this is needed to draw the orbit of the planets and since we do not want to draw the orbit for the sun
+        return self.system.sun == self.index
+
+    @sun.setter
+    def sun(self, value):
+        if value:
+            self.system.sun = self.index
 
-        self.distance_to_sun = 0
-        # used to move planets on their orbit
-        self.x_vel = 0
-        self.y_vel = 0
+    @property
+    def distance_to_sun(self):
+        return self.system.distance_to_sun(self.index)
 
     def draw(self, window, show, move_x, move_y, draw_line):
         x = self.x * self.SCALE + WIDTH / 2
         y = self.y * self.SCALE + HEIGHT / 2
-        if len(self.orbit) > 2:
-            updated_points = []
-            for point in self.orbit:
-                x, y = point
-                x = x * self.SCALE + WIDTH / 2
-                y = y * self.SCALE + HEIGHT / 2
-                updated_points.append((x + move_x, y + move_y))
-            if draw_line:
-                pygame.draw.lines(window, self.color, False, updated_points, 1)
+        if len(self.orbit) > 2 and draw_line:
+            points = self.orbit.points(self.SCALE, (WIDTH / 2 + move_x, HEIGHT / 2 + move_y))
+            pygame.draw.lines(window, self.color, False, points, 1)
         pygame.draw.circle(window, self.color, (x + move_x, y + move_y), self.radius)
         if not self.sun:
             distance_text = FONT_2.render(f"{round(self.distance_to_sun / self.AU, 2)} AU", True, COLOR_WHITE)
@@ -63,41 +427,25 @@ class Planet:
                 window.blit(distance_text, (x - distance_text.get_width() / 2 + move_x,
                                             y - distance_text.get_height() / 2 - 20 + move_y))
 
-    def attraction(self, other):
-        other_x, other_y = other.x, other.y
-        distance_x = other_x - self.x
-        distance_y = other_y - self.y
-        distance = math.sqrt(distance_x ** 2 + distance_y ** 2)
-        if other.sun:
-            self.distance_to_sun = distance
-        # force -> straight line force, we need to break it down to X and y components
-        force = self.G * self.mass * other.mass / distance ** 2
-        theta = math.atan2(distance_y, distance_x)
-        force_x = math.cos(theta) * force
-        force_y = math.sin(theta) * force
-        return force_x, force_y
-
-    def update_position(self, planets):
-        total_fx = total_fy = 0
-        for planet in planets:
-            if self == planet:
-                continue
-            fx, fy = self.attraction(planet)
-            total_fx += fx
-            total_fy += fy
-
-        # F = ma and a = F/m and a = dv/dt and dv = a * dt
-        self.x_vel += total_fx / self.mass * self.TIMESTEP
-        self.y_vel += total_fy / self.mass * self.TIMESTEP
-
-        self.x += self.x_vel * self.TIMESTEP
-        self.y += self.y_vel * self.TIMESTEP
-        self.orbit.append((self.x, self.y))
+    def update_position(self):
+        # the state itself is advanced by Planet.system.step; this records the orbit
+        self.orbit.append(self.x, self.y)
 
     def update_scale(self, scale):
         self.radius *= scale
 
 
+def draw_points(window, pos, color, move_x, move_y):
+    # one pixel per body, written straight into the surface instead of a draw call each
+    x = (pos[:, 0] * Planet.SCALE + WIDTH / 2 + move_x).astype(int)
+    y = (pos[:, 1] * Planet.SCALE + HEIGHT / 2 + move_y).astype(int)
+    w, h = window.get_size()
+    visible = (x >= 0) & (x < w) & (y >= 0) & (y < h)
+    pixels = pygame.surfarray.pixels2d(window)
+    pixels[x[visible], y[visible]] = window.map_rgb(color)
+    del pixels
+
+
 def main():
     run = True
     pause = False
@@ -138,8 +486,39 @@ def main():
 
     planets = [neptune, uranus, saturn, jupiter, mars, earth, venus, mercury, sun]
 
+    # asteroid belt between Mars and Jupiter
+    asteroids = Planet.system.add_ring(N_ASTEROIDS, 2.2 * Planet.AU, 3.2 * Planet.AU)
+    energy_0 = Planet.system.energy()
+    warp = TimeWarp(Planet.TIMESTEP)
+    initial = Planet.system.copy()
+    sim_time = 0  # seconds since the start of the live simulation
+    ephemeris = None
+    pending = None  # ephemeris still being integrated
+    live = None  # live state put aside while an ephemeris is being played back
+    day = 60 * 60 * 24
+    year = 365.25 * day
+
+    def step():
+        nonlocal sim_time
+        Planet.system.step(Planet.TIMESTEP)
+        sim_time += Planet.TIMESTEP
+        for planet in planets:
+            planet.update_position()
+
+    def set_timestep(days):
+        # the live simulation, the time warp and the next ephemeris all use the new step
+        nonlocal energy_0
+        Planet.TIMESTEP = min(max(days, MIN_STEP), MAX_STEP) * day
+        warp.dt = Planet.TIMESTEP
+        warp.reset()
+        energy_0 = Planet.system.energy()
+
+    def clear_orbits():
+        for planet in planets:
+            planet.orbit.clear()
+
     while run:
-        clock.tick(60)
+        wall_dt = min(clock.tick(60) / 1000, 0.25)
         WINDOW.fill(COLOR_UNIVERSE)
 
         for event in pygame.event.get():
@@ -154,6 +533,34 @@ def main():
                 move_x, move_y = -sun.x * sun.SCALE, -sun.y * sun.SCALE
             elif event.type == pygame.KEYDOWN and event.key == pygame.K_s:
                 draw_line = not draw_line
+            elif event.type == pygame.KEYDOWN and event.key == pygame.K_PERIOD:
+                warp.scale(2)
+            elif event.type == pygame.KEYDOWN and event.key == pygame.K_COMMA:
+                warp.scale(0.5)
+            elif event.type == pygame.KEYDOWN and event.key == pygame.K_e:
+                if pending is not None:
+                    pending.cancel()
+                    pending = None
+                elif live is None:
+                    # integrated across the next frames while the live simulation keeps running
+                    initial.integrator = Planet.system.integrator
+                    pending = Ephemeris(initial, Planet.TIMESTEP)
+                else:
+                    Planet.system.pos[:], Planet.system.vel[:] = live
+                    live = None
+                    clear_orbits()
+                    warp.reset()
+            elif event.type == pygame.KEYDOWN and event.key in (pygame.K_LEFTBRACKET, pygame.K_RIGHTBRACKET):
+                if live is not None:
+                    play_time += year if event.key == pygame.K_RIGHTBRACKET else -year
+                    play_time = min(max(play_time, 0), ephemeris.duration)
+                    clear_orbits()
+            elif event.type == pygame.KEYDOWN and event.key == pygame.K_i:
+                index = INTEGRATORS.index(Planet.system.integrator)
+                Planet.system.integrator = INTEGRATORS[(index + 1) % len(INTEGRATORS)]
+                set_timestep(INTEGRATOR_STEPS[Planet.system.integrator])
+            elif event.type == pygame.KEYDOWN and event.key in (pygame.K_MINUS, pygame.K_EQUALS):
+                set_timestep(Planet.TIMESTEP / day * (2 if event.key == pygame.K_EQUALS else 0.5))
             elif event.type == pygame.MOUSEBUTTONDOWN and event.button == 5:
                 Planet.SCALE *= 0.75
                 for planet in planets:
@@ -177,9 +584,29 @@ def main():
         if keys[pygame.K_DOWN] or mouse_y == window_h - 1:
             move_y -= distance
 
-        for planet in planets:
+        if pending is not None and pending.build(warp.budget):
+            ephemeris, pending = pending, None
+            live = Planet.system.pos.copy(), Planet.system.vel.copy()
+            play_time = min(sim_time, ephemeris.duration)
+            clear_orbits()
+            warp.reset()
+
+        if live is not None:
+            # playback: no force evaluations, only interpolation in the cached ephemeris
             if not pause:
-                planet.update_position(planets)
+                play_time = min(play_time + wall_dt * 60 * warp.warp * Planet.TIMESTEP, ephemeris.duration)
+            Planet.system.pos[:], Planet.system.vel[:] = ephemeris.state(play_time)
+            if not pause:
+                for planet in planets:
+                    planet.update_position()
+        elif not pause:
+            warp.advance(step, wall_dt)
+        else:
+            warp.reset()
+
+        draw_points(WINDOW, Planet.system.pos[asteroids], COLOR_ASTEROID, move_x, move_y)
+
+        for planet in planets:
             if show_distance:
                 planet.draw(WINDOW, 1, move_x, move_y, draw_line)
             else:
@@ -201,24 +628,50 @@ def main():
         WINDOW.blit(text_surface, (15, 195))
         text_surface = FONT_1.render("Use scroll-wheel to zoom", True, COLOR_WHITE)
         WINDOW.blit(text_surface, (15, 225))
+        text_surface = FONT_1.render("Press I to switch integrator, - / = to halve/double its step", True, COLOR_WHITE)
+        WINDOW.blit(text_surface, (15, 255))
+        text_surface = FONT_1.render("Press , / . to slow down/speed up time", True, COLOR_WHITE)
+        WINDOW.blit(text_surface, (15, 285))
+        text_surface = FONT_1.render("Press E for ephemeris playback, [ / ] to seek a year", True, COLOR_WHITE)
+        WINDOW.blit(text_surface, (15, 315))
         sun_surface = FONT_1.render("- Sun", True, COLOR_SUN)
-        WINDOW.blit(sun_surface, (15, 285))
+        WINDOW.blit(sun_surface, (15, 345))
         mercury_surface = FONT_1.render("- Mercury", True, COLOR_MERCURY)
-        WINDOW.blit(mercury_surface, (15, 315))
+        WINDOW.blit(mercury_surface, (15, 375))
         venus_surface = FONT_1.render("- Venus", True, COLOR_VENUS)
-        WINDOW.blit(venus_surface, (15, 345))
+        WINDOW.blit(venus_surface, (15, 405))
         earth_surface = FONT_1.render("- Earth", True, COLOR_EARTH)
-        WINDOW.blit(earth_surface, (15, 375))
+        WINDOW.blit(earth_surface, (15, 435))
         mars_surface = FONT_1.render("- Mars", True, COLOR_MARS)
-        WINDOW.blit(mars_surface, (15, 405))
+        WINDOW.blit(mars_surface, (15, 465))
         jupiter_surface = FONT_1.render("- Jupiter", True, COLOR_JUPITER)
-        WINDOW.blit(jupiter_surface, (15, 435))
+        WINDOW.blit(jupiter_surface, (15, 495))
         saturn_surface = FONT_1.render("- Saturn", True, COLOR_SATURN)
-        WINDOW.blit(saturn_surface, (15, 465))
+        WINDOW.blit(saturn_surface, (15, 525))
         uranus_surface = FONT_1.render("- Uranus", True, COLOR_URANUS)
-        WINDOW.blit(uranus_surface, (15, 495))
+        WINDOW.blit(uranus_surface, (15, 555))
         neptune_surface = FONT_1.render("- Neptune", True, COLOR_NEPTUNE)
-        WINDOW.blit(neptune_surface, (15, 525))
+        WINDOW.blit(neptune_surface, (15, 585))
+        drift = abs((Planet.system.energy() - energy_0) / energy_0)
+        text_surface = FONT_1.render("Integrator: %s, step %g days" % (Planet.system.integrator, Planet.TIMESTEP / day),
+                                     True, COLOR_WHITE)
+        WINDOW.blit(text_surface, (15, 645))
+        text_surface = FONT_1.render("Energy drift: %.2e" % drift, True, COLOR_WHITE)
+        WINDOW.blit(text_surface, (15, 675))
+        days_per_second = warp.days_per_second if live is None else warp.warp * 60 * Planet.TIMESTEP / (60 * 60 * 24)
+        text_surface = FONT_1.render("Time warp: x%g (%.0f days/s)" % (warp.warp, days_per_second), True,
+                                     COLOR_WHITE)
+        WINDOW.blit(text_surface, (15, 705))
+        if live is None:
+            text_surface = FONT_1.render("Steps/s: %d" % warp.steps_per_second, True, COLOR_WHITE)
+        else:
+            text_surface = FONT_1.render("Playback: year %.1f of %.0f" % (play_time / year, ephemeris.duration / year),
+                                         True, COLOR_WHITE)
+        WINDOW.blit(text_surface, (15, 735))
+        if pending is not None:
+            text_surface = FONT_1.render("Integrating ephemeris... %d%% (E to cancel)" % (100 * pending.progress),
+                                         True, COLOR_WHITE)
+            WINDOW.blit(text_surface, (WIDTH / 2 - text_surface.get_width() / 2, HEIGHT / 2))
 
         pygame.display.update()
 
@@ -1,6 +1,11 @@
 import numpy as np
 import matplotlib.pyplot as plt
 from scipy.special import gamma
+from scipy.spatial import cKDTree
+try:
+	from gravitation.n_body import getAccTree
+except ImportError:
+	from n_body import getAccTree   # run from inside gravitation/
 
 
 def W( x, y, z, h ):
@@ -40,6 +45,45 @@ def gradW( x, y, z, h ):
 	return wx, wy, wz
 	
 	
+def cubicW( x, y, z, h ):
+	"""
+	Cubic spline smoothing kernel (3D), which vanishes beyond r = 2h
+	x     is a vector/matrix of x positions
+	y     is a vector/matrix of y positions
+	z     is a vector/matrix of z positions
+	h     is the smoothing length
+	w     is the evaluated smoothing function
+	"""
+	
+	q = np.sqrt(x**2 + y**2 + z**2) / h
+	
+	w = np.where( q < 1, 1 - 1.5*q**2 + 0.75*q**3, 0.25*np.maximum(2-q, 0)**3 ) / (np.pi*h**3)
+	
+	return w
+	
+	
+def cubicGradW( x, y, z, h ):
+	"""
+	Gradient of the cubic spline smoothing kernel (3D)
+	x     is a vector/matrix of x positions
+	y     is a vector/matrix of y positions
+	z     is a vector/matrix of z positions
+	h     is the smoothing length
+	wx, wy, wz     is the evaluated gradient
+	"""
+	
+	r = np.sqrt(x**2 + y**2 + z**2)
+	q = r / h
+	
+	dwdq = np.where( q < 1, -3*q + 2.25*q**2, -0.75*np.maximum(2-q, 0)**2 ) / (np.pi*h**3)
+	n = np.where( r > 0, dwdq / (h * np.where(r > 0, r, 1)), 0 )
+	wx = n * x
+	wy = n * y
+	wz = n * z
+	
+	return wx, wy, wz
+	
+	
 def getPairwiseSeparations( ri, rj ):
 	"""
 	Get pairwise desprations between 2 sets of coordinates
@@ -69,18 +113,124 @@ def getPairwiseSeparations( ri, rj ):
 	return dx, dy, dz
 	
 
-def getDensity( r, pos, m, h ):
+def getPairs( pos, radius ):
+	"""
+	Get all pairs of SPH particles closer than radius, each pair once (i < j)
+	pos    is an N x 3 matrix of positions
+	radius is the search radius
+	i, j   are vectors of particle indices
+	"""
+	
+	pairs = cKDTree( pos ).query_pairs( radius, output_type='ndarray' )
+	
+	return pairs[:,0], pairs[:,1]
+	
+	
+def getNeighbours( r, pos, radius ):
+	"""
+	Get all (sampling location, SPH particle) pairs closer than radius
+	r      is an M x 3 matrix of sampling locations
+	pos    is an N x 3 matrix of SPH particle positions
+	radius is the search radius
+	i, j   are vectors of indices into r and pos
+	"""
+	
+	pairs = cKDTree( r ).sparse_distance_matrix( cKDTree( pos ), radius, output_type='ndarray' )
+	
+	return pairs['i'], pairs['j']
+	
+	
+def getSmoothingLengths( pos, nNeighbours ):
+	"""
+	Get per-particle smoothing lengths, such that each particle has
+	nNeighbours neighbours within 2h, and the pairs that interact through
+	the symmetrised smoothing length (h_i + h_j)/2
+	pos    is an N x 3 matrix of positions
+	nNeighbours is the target number of neighbours
+	h      is an N vector of smoothing lengths
+	i, j   are vectors of particle indices of interacting pairs (i < j)
+	"""
+	
+	N = pos.shape[0]
+	nNeighbours = min(nNeighbours, N-1)
+	
+	# distance to the nNeighbours-th nearest neighbour (the first hit is the particle itself)
+	dist, idx = cKDTree( pos ).query( pos, k=nNeighbours+1 )
+	h = dist[:,-1] / 2
+	
+	# r_ij < h_i + h_j means j is a neighbour of i or i one of j, so the
+	# neighbour lists contain every interacting pair
+	i = np.repeat(np.arange(N), nNeighbours)
+	j = idx[:,1:].ravel()
+	key = np.unique( np.minimum(i, j) * N + np.maximum(i, j) )
+	i, j = key // N, key % N
+	near = np.sum((pos[i] - pos[j])**2, 1) < (h[i] + h[j])**2
+	
+	return h, i[near], j[near]
+	
+	
+class VerletList:
+	"""
+	Verlet neighbour list: stores the pairs within radius + skin and only
+	rebuilds them once some particle has moved more than skin/2 since the
+	last build, so no pair can have come within radius unnoticed
+	radius is the interaction radius (2h for the cubic spline)
+	skin   is the extra search distance
+	"""
+	
+	def __init__( self, radius, skin ):
+		self.radius = radius
+		self.skin = skin
+		self.pos0 = None     # positions at the last build
+		self.i = self.j = None
+		self.nCalls = 0      # number of getPairs calls
+		self.nBuilds = 0     # number of rebuilds
+		
+	def getPairs( self, pos ):
+		"""
+		Get all pairs closer than radius, each pair once (i < j)
+		pos    is an N x 3 matrix of positions
+		i, j   are vectors of particle indices
+		"""
+		self.nCalls += 1
+		
+		if self.pos0 is None or self.pos0.shape != pos.shape or \
+		   np.max(np.sum((pos - self.pos0)**2, 1)) > (self.skin/2)**2:
+			self.i, self.j = getPairs( pos, self.radius + self.skin )
+			self.pos0 = pos.copy()
+			self.nBuilds += 1
+		
+		# candidates that are actually within the interaction radius
+		d = pos[self.i] - pos[self.j]
+		near = np.sum(d**2, 1) < self.radius**2
+		
+		return self.i[near], self.j[near]
+		
+	def hitRate( self ):
+		""" fraction of getPairs calls that reused the stored list """
+		return 1 - self.nBuilds / max(self.nCalls, 1)
+	
+	
+def getDensity( r, pos, m, h, kernel='gaussian' ):
 	"""
 	Get Density at sampling loctions from SPH particle distribution
 	r     is an M x 3 matrix of sampling locations
 	pos   is an N x 3 matrix of SPH particle positions
 	m     is the particle mass
-	h     is the smoothing length
+	h     is the smoothing length (or, for 'cubic', an N vector of them)
+	kernel is 'gaussian' (all pairs) or 'cubic' (neighbours within 2h)
 	rho   is M x 1 vector of densities
 	"""
 	
 	M = r.shape[0]
 	
+	if kernel == 'cubic':
+		i, j = getNeighbours( r, pos, 2*np.max(h) )
+		d = r[i] - pos[j]
+		hj = h[j] if np.ndim(h) else h
+		w = cubicW( d[:,0], d[:,1], d[:,2], hj )
+		return np.bincount( i, weights=m*w, minlength=M ).reshape((M,1))
+	
 	dx, dy, dz = getPairwiseSeparations( r, pos );
 	
 	rho = np.sum( m * W(dx, dy, dz, h), 1 ).reshape((M,1))
@@ -88,6 +238,24 @@ def getDensity( r, pos, m, h ):
 	return rho
 	
 	
+def getFieldsDensity( pos, m, h, kernel, fields ):
+	"""
+	Get Density at the SPH particles, reusing the one left in fields by getAcc
+	when it was computed at the same positions
+	pos   is an N x 3 matrix of SPH particle positions
+	m     is the particle mass
+	h     is the smoothing length
+	kernel is the smoothing kernel, as in getDensity
+	fields is the dict filled by getAcc
+	rho   is N x 1 vector of densities
+	"""
+	
+	if 'pos' in fields and np.array_equal( fields['pos'], pos ):
+		return fields['rho']
+	
+	return getDensity( pos, pos, m, h, kernel )
+	
+	
 def getPressure(rho, k, n):
 	"""
 	Equation of State
@@ -102,7 +270,77 @@ def getPressure(rho, k, n):
 	return P
 	
 
-def getAcc( pos, vel, m, h, k, n, lmbda, nu ):
+def getAccCubic( pos, m, h, k, n, nlist=None, fields=None, nNeighbours=0 ):
+	"""
+	Pressure acceleration on each SPH particle with the cubic spline kernel,
+	summed over neighbour pairs only
+	pos   is an N x 3 matrix of positions
+	m     is the particle mass
+	h     is the smoothing length
+	k     equation of state constant
+	n     polytropic index
+	nlist is an optional VerletList to take the neighbour pairs from
+	fields is an optional dict that receives the derived fields (see getAcc)
+	nNeighbours is the target neighbour count for per-particle smoothing
+	      lengths (0: use the fixed h)
+	a     is N x 3 matrix of accelerations
+	"""
+	
+	N = pos.shape[0]
+	
+	# neighbour pairs, each evaluated once (i < j), and their smoothing lengths
+	if nNeighbours > 0:
+		h, i, j = getSmoothingLengths( pos, nNeighbours )
+		hij = 0.5 * (h[i] + h[j])
+	elif nlist is None:
+		i, j = getPairs( pos, 2*h )
+		hij = h
+	else:
+		i, j = nlist.getPairs( pos )
+		hij = h
+	d = pos[i] - pos[j]
+	
+	# densities (including each particle's own contribution) and pressures;
+	# the kernel is symmetric, so each pair adds to both particles
+	w = m * cubicW( d[:,0], d[:,1], d[:,2], hij )
+	rho = m * cubicW( 0, 0, 0, h ) + np.bincount( i, weights=w, minlength=N ) + np.bincount( j, weights=w, minlength=N )
+	P = getPressure(rho, k, n)
+	
+	if fields is not None:
+		fields.update( pos=pos.copy(), rho=rho.reshape((N,1)), P=P.reshape((N,1)), pairs=(i, j), h=h )
+	
+	# Add Pressure contribution to accelerations; the pair force is
+	# antisymmetric (Newton's third law), so j gets the opposite of i
+	dWx, dWy, dWz = cubicGradW( d[:,0], d[:,1], d[:,2], hij )
+	Prho2 = P / rho**2
+	f = m * ( Prho2[i] + Prho2[j] )
+	a = np.zeros((N,3))
+	for c, dW in enumerate((dWx, dWy, dWz)):
+		fc = f * dW
+		a[:,c] = np.bincount( j, weights=fc, minlength=N ) - np.bincount( i, weights=fc, minlength=N )
+	
+	return a
+	
+
+def getSelfGravity( pos, m, h, G, theta ):
+	"""
+	Self-gravity of the SPH particles from a Barnes-Hut octree, O(N log N),
+	with the smoothing length as the softening length
+	pos   is an N x 3 matrix of positions
+	m     is the particle mass
+	h     is the smoothing length (or an N vector of them)
+	G     is the gravitational constant (0: no self-gravity)
+	theta is the opening angle
+	a     is N x 3 matrix of accelerations
+	"""
+	
+	if G == 0:
+		return 0
+	
+	return getAccTree( pos, m * np.ones((pos.shape[0],1)), G, h, theta )
+	
+
+def getAcc( pos, vel, m, h, k, n, lmbda, nu, kernel='gaussian', nlist=None, fields=None, nNeighbours=0, G=0, theta=0.5 ):
 	"""
 	Calculate the acceleration on each SPH particle
 	pos   is an N x 3 matrix of positions
@@ -113,25 +351,48 @@ def getAcc( pos, vel, m, h, k, n, lmbda, nu ):
 	n     polytropic index
 	lmbda external force constant
 	nu    viscosity
+	kernel is 'gaussian' (all pairs) or 'cubic' (neighbours within 2h)
+	nlist is an optional VerletList for the 'cubic' kernel
+	fields is an optional dict that receives the fields derived on the way:
+	      'pos' (a copy of the positions they belong to), 'rho', 'P'
+	      and, for the 'cubic' kernel, the neighbour 'pairs' and 'h'
+	nNeighbours is the target neighbour count for per-particle smoothing
+	      lengths ('cubic' kernel only, 0: use the fixed h)
+	G     is the gravitational constant for self-gravity (0: off)
+	theta is the Barnes-Hut opening angle of the self-gravity tree
 	a     is N x 3 matrix of accelerations
 	"""
 	
 	N = pos.shape[0]
 	
+	if fields is None:
+		fields = {}
+	
+	if kernel == 'cubic':
+		a = getAccCubic( pos, m, h, k, n, nlist, fields, nNeighbours )
+		a -= lmbda * pos
+		a -= nu * vel
+		return a + getSelfGravity( pos, m, fields.get('h', h), G, theta )
+	
+	# Get pairwise distances, used for both the densities and the gradients
+	dx, dy, dz = getPairwiseSeparations( pos, pos )
+	
 	# Calculate densities at the position of the particles
-	rho = getDensity( pos, pos, m, h )
+	rho = np.sum( m * W(dx, dy, dz, h), 1 ).reshape((N,1))
 	
 	# Get the pressures
 	P = getPressure(rho, k, n)
 	
-	# Get pairwise distances and gradients
-	dx, dy, dz = getPairwiseSeparations( pos, pos )
-	dWx, dWy, dWz = gradW( dx, dy, dz, h )
+	if fields is not None:
+		fields.update( pos=pos.copy(), rho=rho, P=P )
 	
 	# Add Pressure contribution to accelerations
-	ax = - np.sum( m * ( P/rho**2 + P.T/rho.T**2  ) * dWx, 1).reshape((N,1))
-	ay = - np.sum( m * ( P/rho**2 + P.T/rho.T**2  ) * dWy, 1).reshape((N,1))
-	az = - np.sum( m * ( P/rho**2 + P.T/rho.T**2  ) * dWz, 1).reshape((N,1))
+	dWx, dWy, dWz = gradW( dx, dy, dz, h )
+	Prho2 = P/rho**2
+	f = m * ( Prho2 + Prho2.T )
+	ax = - np.sum( f * dWx, 1).reshape((N,1))
+	ay = - np.sum( f * dWy, 1).reshape((N,1))
+	az = - np.sum( f * dWz, 1).reshape((N,1))
 	
 	# pack together the acceleration components
 	a = np.hstack((ax,ay,az))
@@ -142,10 +403,38 @@ def getAcc( pos, vel, m, h, k, n, lmbda, nu ):
 	# Add viscosity
 	a -= nu * vel
 	
+	# Add self-gravity
+	a += getSelfGravity( pos, m, h, G, theta )
+	
 	return a
 	
 
 
+def getTimestep( h, vel, acc, rho, k, n, Ccfl ):
+	"""
+	Get the largest stable timestep of each SPH particle from the CFL
+	condition and the force condition
+	h     is the smoothing length (or an N vector of them)
+	vel   is an N x 3 matrix of velocities
+	acc   is an N x 3 matrix of accelerations
+	rho   is an N x 1 vector of densities
+	k     equation of state constant
+	n     polytropic index
+	Ccfl  is the Courant number
+	dt    is an N vector of timesteps
+	"""
+	
+	# sound speed of the polytrope, c^2 = dP/drho
+	cs = np.sqrt( k * (1+1/n) * rho.flatten()**(1/n) )
+	v = np.sqrt( np.sum(vel**2, 1) )
+	a = np.sqrt( np.sum(acc**2, 1) )
+	
+	dt_cfl = Ccfl * h / (cs + v)
+	dt_force = Ccfl * np.sqrt( h / np.maximum(a, 1e-300) )
+	
+	return np.minimum(dt_cfl, dt_force)
+	
+	
 def main():
 	""" SPH simulation """
 	
@@ -153,13 +442,21 @@ def main():
 	N         = 400    # Number of particles
 	t         = 0      # current time of the simulation
 	tEnd      = 12     # time at which simulation ends
-	dt        = 0.04   # timestep
+	dt        = 0.04   # timestep (the largest one if adaptiveDt is on)
 	M         = 2      # star mass
 	R         = 0.75   # star radius
-	h         = 0.1    # smoothing length
+	h         = 0.1    # smoothing length (~0.2 for the 'cubic' kernel)
 	k         = 0.1    # equation of state constant
 	n         = 1      # polytropic index
 	nu        = 1      # damping
+	kernel    = 'gaussian' # smoothing kernel: 'gaussian' (all pairs) or compact 'cubic' spline
+	skin      = 0.05   # Verlet list skin ('cubic' kernel only)
+	nNeighbours = 0    # target neighbour count for per-particle h ('cubic' kernel only, 0: fixed h)
+	adaptiveDt = False # limit the timestep by the CFL and force conditions
+	Ccfl      = 0.3    # Courant number for adaptiveDt
+	selfGravity = False # hold the gas together by self-gravity instead of the external potential
+	G         = 1      # gravitational constant (selfGravity only)
+	theta     = 0.5    # Barnes-Hut opening angle (selfGravity only)
 	plotRealTime = True # switch on for plotting as the simulation goes along
 	
 	# Generate Initial Conditions
@@ -170,11 +467,19 @@ def main():
 	pos   = np.random.randn(N,3)   # randomly selected positions and velocities
 	vel   = np.zeros(pos.shape)
 	
-	# calculate initial gravitational accelerations
-	acc = getAcc( pos, vel, m, h, k, n, lmbda, nu )
+	# self-gravity replaces the external potential
+	lmbdaExt = 0 if selfGravity else lmbda
+	Gself = G if selfGravity else 0
 	
-	# number of timesteps
-	Nt = int(np.ceil(tEnd/dt))
+	# neighbour list reused across steps until particles have moved too far
+	nlist = VerletList( 2*h, skin ) if kernel == 'cubic' and nNeighbours == 0 else None
+	
+	# per-step fields (density, pressure, neighbours) left behind by getAcc
+	fields = {}
+	
+	# calculate initial gravitational accelerations
+	acc = getAcc( pos, vel, m, h, k, n, lmbdaExt, nu, kernel, nlist, fields, nNeighbours, Gself, theta )
+	nSteps = 0
 	
 	# prep figure
 	fig = plt.figure(figsize=(4,5), dpi=80)
@@ -187,27 +492,35 @@ def main():
 	rho_analytic = lmbda/(4*k) * (R**2 - rlin**2)
 	
 	# Simulation Main Loop
-	for i in range(Nt):
+	while t < tEnd - 1e-6*dt:
+		# timestep, limited by the CFL and force conditions if requested
+		dt_step = dt
+		if adaptiveDt:
+			dt_step = min(dt, np.min(getTimestep( fields.get('h', h), vel, acc, fields['rho'], k, n, Ccfl )))
+		dt_step = min(dt_step, tEnd - t)
+		last = t + dt_step >= tEnd - 1e-6*dt
+		
 		# (1/2) kick
-		vel += acc * dt/2
+		vel += acc * dt_step/2
 		
 		# drift
-		pos += vel * dt
+		pos += vel * dt_step
 		
 		# update accelerations
-		acc = getAcc( pos, vel, m, h, k, n, lmbda, nu )
+		acc = getAcc( pos, vel, m, h, k, n, lmbdaExt, nu, kernel, nlist, fields, nNeighbours, Gself, theta )
 		
 		# (1/2) kick
-		vel += acc * dt/2
+		vel += acc * dt_step/2
 		
 		# update time
-		t += dt
+		t += dt_step
+		nSteps += 1
 		
-		# get density for plotting
-		rho = getDensity( pos, pos, m, h )
+		# get density for plotting (already computed by getAcc at these positions)
+		rho = getFieldsDensity( pos, m, h, kernel, fields )
 		
 		# plot in real time
-		if plotRealTime or (i == Nt-1):
+		if plotRealTime or last:
 			plt.sca(ax1)
 			plt.cla()
 			cval = np.minimum((rho-3)/3,1).flatten()
@@ -224,12 +537,16 @@ def main():
 			ax2.set(xlim=(0, 1), ylim=(0, 3))
 			ax2.set_aspect(0.1)
 			plt.plot(rlin, rho_analytic, color='gray', linewidth=2)
-			rho_radial = getDensity( rr, pos, m, h )
+			rho_radial = getDensity( rr, pos, m, fields.get('h', h), kernel )
 			plt.plot(rlin, rho_radial, color='blue')
 			plt.pause(0.001)
 	    
 	
 	
+	print(f"{nSteps} steps, mean timestep {tEnd/nSteps:.3g}")
+	if nlist is not None:
+		print(f"neighbour list: {nlist.nBuilds} builds in {nlist.nCalls} steps, hit rate {nlist.hitRate():.2f}")
+	
 	# add labels/legend
 	plt.sca(ax2)
 	plt.xlabel('radius')